@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Benchmarks croissant against synthetic blogs.
+
+Generates a source tree with N posts, pages and media files, then times a
+fixed sequence of scenarios, each one a full `Croissant(root).update()` run in
+its own process so peak memory and file system counters aren't shared:
+
+    python3 benchmark.py --posts 2000 --output before.json
+    python3 benchmark.py --posts 2000 --output after.json
+    python3 benchmark.py --compare before.json after.json
+
+Markdown renderers are compared the same way, running one of the two with
+e.g. `--renderer mistune`.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+from datetime import datetime, timedelta
+
+
+SCENARIOS = ('cold', 'noop', 'edit_new', 'edit_old', 'rename', 'delete', 'media')
+
+WORDS = ('croissant butter flour dough oven bake layer crust morning coffee '
+         'jam bread sugar salt yeast fold roll golden crisp warm paris cafe '
+         'static file blog engine markdown page post archive feed').split()
+
+# File system calls counted while a scenario runs
+COUNTED_CALLS = ('stat', 'lstat', 'listdir', 'scandir', 'replace', 'rename',
+                 'remove', 'mkdir', 'rmdir', 'link')
+
+
+def paragraph(rnd, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rnd.choice(WORDS)
+        if rnd.random() < 0.05:
+            word = '*%s*' % word
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def write_post(path, title, date, body, slug=None):
+    with open(path, 'w') as post:
+        post.write('%s\n%s\n' % (title, '=' * max(3, len(title))))
+        post.write('date: %s\n' % date.strftime('%Y-%m-%d'))
+        if slug:
+            post.write('slug: %s\n' % slug)
+        post.write('\n%s\n' % body)
+
+
+def post_body(rnd, size, media_count):
+    paragraphs = []
+    length = 0
+    while length < size:
+        text = paragraph(rnd, min(600, size - length + 1))
+        if media_count and rnd.random() < 0.2:
+            text += '\n\n![image](../media/file-%05d.bin)' % rnd.randrange(media_count)
+        paragraphs.append(text)
+        length += len(text) + 2
+    return '\n\n'.join(paragraphs)
+
+
+def generate_site(root, posts, post_size, pages, media, media_size, workers, seed,
+                  renderer=None):
+    """ Creates a croissant root (config and templates) with its source
+    directory and webroot inside it. Returns the post names, oldest first.
+    """
+    rnd = random.Random(seed)
+    source = os.path.join(root, 'source')
+    for directory in ('config', 'source/posts', 'source/pages', 'source/media'):
+        os.makedirs(os.path.join(root, directory))
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'),
+                    os.path.join(root, 'templates'))
+
+    with open(os.path.join(root, 'config', 'config.yaml'), 'w') as config:
+        config.write('blog:\n'
+                     '    title: Benchmark blog\n'
+                     '    url: http://www.example.com/\n'
+                     '    description: Synthetic blog\n\n'
+                     'public_drafts: False\n'
+                     'posts_in_homepage: 10\n'
+                     'source_path: %s\n'
+                     'webroot: %s\n' % (source, os.path.join(root, 'webroot')))
+        if workers:
+            config.write('workers: %d\n' % workers)
+        if renderer:
+            config.write('markdown_renderer: %s\n' % renderer)
+
+    names = []
+    first_date = datetime(2005, 1, 1)
+    for number in range(posts):
+        name = 'post-%05d.md' % number
+        date = first_date + timedelta(days=number * 5000 // max(posts, 1))
+        write_post(os.path.join(source, 'posts', name), 'Post number %d' % number,
+                   date, post_body(rnd, post_size, media))
+        names.append(name)
+
+    for number in range(pages):
+        with open(os.path.join(source, 'pages', 'page-%03d.md' % number), 'w') as page:
+            page.write('Page %d\n======\n\n%s\n' % (number, post_body(rnd, post_size, 0)))
+
+    for number in range(media):
+        with open(os.path.join(source, 'media', 'file-%05d.bin' % number), 'wb') as data:
+            data.write(os.urandom(media_size))
+
+    return names
+
+
+def read_post(path):
+    with open(path, 'r') as post:
+        return post.read()
+
+
+def prepare(scenario, root, names):
+    """ Makes the source change a scenario measures """
+    source = os.path.join(root, 'source')
+    posts = os.path.join(source, 'posts')
+    if scenario == 'cold':
+        for directory in ('webroot', 'cache'):
+            shutil.rmtree(os.path.join(root, directory), ignore_errors=True)
+        for filename in os.listdir(os.path.join(root, 'config')):
+            if filename != 'config.yaml':
+                os.remove(os.path.join(root, 'config', filename))
+    elif scenario in ('edit_new', 'edit_old'):
+        name = names[-1] if scenario == 'edit_new' else names[0]
+        with open(os.path.join(posts, name), 'a') as post:
+            post.write('\nOne more line, edited at %f.\n' % time.time())
+    elif scenario == 'rename':
+        name = names[len(names) // 2]
+        text = read_post(os.path.join(posts, name))
+        (title, rest) = text.split('\n', 1)
+        with open(os.path.join(posts, name), 'w') as post:
+            post.write('%s\n%s' % (title, rest.replace('\n\n', '\nslug: renamed-post\n\n', 1)))
+    elif scenario == 'delete':
+        os.remove(os.path.join(posts, names.pop(len(names) // 3)))
+    elif scenario == 'media':
+        media = sorted(os.listdir(os.path.join(source, 'media')))
+        if media:
+            with open(os.path.join(source, 'media', media[0]), 'ab') as data:
+                data.write(b'changed')
+        with open(os.path.join(source, 'media', 'new-file.bin'), 'wb') as data:
+            data.write(os.urandom(4096))
+
+
+def proc_io():
+    """ Kernel I/O counters of this process (Linux only) """
+    try:
+        with open('/proc/self/io', 'r') as io:
+            return dict((key, int(value)) for (key, value)
+                        in (line.split(': ') for line in io.read().splitlines()))
+    except IOError:
+        return {}
+
+
+def count_calls(counts):
+    """ Wraps the os functions croissant uses for file system access, plus
+    open(), so the number of calls made during a run can be reported
+    """
+    import builtins
+
+    def counted(name, function):
+        def wrapper(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    for name in COUNTED_CALLS:
+        setattr(os, name, counted(name, getattr(os, name)))
+    builtins.open = counted('open', builtins.open)
+
+
+def run_once(root, croissant_dir):
+    """ Runs in a child process: one full update, reported as JSON """
+    started = time.perf_counter()
+    sys.path.insert(0, croissant_dir)
+    from croissant import Croissant
+    imported = time.perf_counter()
+
+    counts = {}
+    io_before = proc_io()
+    cpu_before = time.process_time()
+    count_calls(counts)
+
+    update_started = time.perf_counter()
+    croissant = Croissant(root)
+    try:
+        croissant.update()
+    finally:
+        croissant.close()
+    finished = time.perf_counter()
+
+    io_after = proc_io()
+    result = {
+        'wall': finished - update_started,
+        'import': imported - started,
+        'cpu': time.process_time() - cpu_before,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'fs_calls': counts,
+        # os.scandir entries are stat'ed without going through os.stat
+        'scanner': dict((key, croissant.stats.counters.get(key, 0))
+                        for key in ('scandir calls', 'stat calls')),
+        'io': dict((key, io_after[key] - io_before.get(key, 0)) for key in io_after),
+    }
+    return result
+
+
+def measure(root):
+    child = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-once', root],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if child.returncode:
+        sys.stderr.write(child.stderr)
+        sys.exit('Scenario failed in %s' % root)
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def benchmark(args):
+    samples = dict((scenario, []) for scenario in args.scenarios)
+    for repeat in range(args.repeat):
+        root = tempfile.mkdtemp(prefix='croissant-bench-', dir=args.workdir)
+        try:
+            names = generate_site(root, args.posts, args.post_size, args.pages,
+                                  args.media, args.media_size, args.workers, args.seed,
+                                  args.renderer)
+            for scenario in SCENARIOS:
+                # Scenarios build on each other, so skipped ones still run, unmeasured
+                prepare(scenario, root, names)
+                result = measure(root)
+                if scenario in samples:
+                    samples[scenario].append(result)
+                    print('%-9s run %d: %.3fs' % (scenario, repeat + 1, result['wall']),
+                          file=sys.stderr)
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+
+    results = {}
+    for scenario, runs in samples.items():
+        results[scenario] = {
+            'wall': median([run['wall'] for run in runs]),
+            'wall_min': min(run['wall'] for run in runs),
+            'cpu': median([run['cpu'] for run in runs]),
+            'import': median([run['import'] for run in runs]),
+            'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+            'children_peak_rss_kb': max(run['children_peak_rss_kb'] for run in runs),
+            'fs_calls': runs[-1]['fs_calls'],
+            'scanner': runs[-1].get('scanner', {}),
+            'io': runs[-1]['io'],
+            'runs': len(runs),
+        }
+
+    return {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {
+            'posts': args.posts, 'post_size': args.post_size, 'pages': args.pages,
+            'media': args.media, 'media_size': args.media_size,
+            'workers': args.workers, 'repeat': args.repeat, 'seed': args.seed,
+            'renderer': args.renderer,
+        },
+        'scenarios': results,
+    }
+
+
+def compare(base_path, new_path, threshold):
+    """ Prints how each scenario changed between two result files. Returns
+    True when any scenario got slower by more than the threshold.
+    """
+    with open(base_path, 'r') as base_file:
+        base = json.load(base_file)
+    with open(new_path, 'r') as new_file:
+        new = json.load(new_file)
+    if base['parameters'] != new['parameters']:
+        print('Warning: the runs used different parameters')
+
+    regressed = False
+    print('%-9s %10s %10s %8s %12s %12s' % ('scenario', 'base (s)', 'new (s)', 'change',
+                                          'base rss', 'new rss'))
+    for scenario in SCENARIOS:
+        if scenario not in base['scenarios'] or scenario not in new['scenarios']:
+            continue
+        old = base['scenarios'][scenario]
+        current = new['scenarios'][scenario]
+        change = (current['wall'] - old['wall']) / old['wall'] if old['wall'] else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print('%-9s %10.3f %10.3f %+7.1f%% %10dkB %10dkB%s' % (
+            scenario, old['wall'], current['wall'], change * 100,
+            old['peak_rss_kb'], current['peak_rss_kb'], flag))
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark croissant on a synthetic blog')
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--post-size', type=int, default=4000,
+                        help='approximate size of each post body, in bytes')
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--media', type=int, default=50)
+    parser.add_argument('--media-size', type=int, default=64 * 1024, help='in bytes')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='value of the workers setting (default: croissant\'s own)')
+    parser.add_argument('--renderer',
+                        help='value of the markdown_renderer setting (default: croissant\'s own)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS),
+                        choices=SCENARIOS)
+    parser.add_argument('--workdir', help='where to generate the synthetic blogs')
+    parser.add_argument('--keep', action='store_true', help='keep the generated blogs')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown ratio reported as a regression by --compare')
+    parser.add_argument('--run-once', metavar='ROOT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once:
+        # Keeping croissant's own output out of the JSON on stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            result = run_once(args.run_once, os.path.dirname(os.path.abspath(__file__)))
+        finally:
+            sys.stdout.flush()
+            sys.stdout = stdout
+        print(json.dumps(result))
+        sys.exit(0)
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    results = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
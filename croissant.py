@@ -3,37 +3,1009 @@
 
 import os
 import sys
-from shutil import copyfile
+import functools
+import contextlib
+import hashlib
+import io
+import json
+import threading
+import bisect
 import glob
+import heapq
 import time
 from datetime import datetime
 from collections import OrderedDict
 
 import re
-import markdown
-import yaml
-import unidecode
-from jinja2 import Environment, FileSystemLoader
+
+""" markdown, yaml, unidecode, jinja2 and the standard library modules for
+process pools, SQLite and compression take longer to import than a run with
+nothing to do takes in total, so they are imported where they're used.
+"""
 
 
 def slugify(text):
+    import unidecode
     # credits: http://stackoverflow.com/a/8366771
     text = unidecode.unidecode(text.strip()).lower()
     return re.sub(r'\W+', '-', text)
 
 
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# ioctl request number for a copy-on-write clone of a whole file (Linux)
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def zero_copy_file(src, dst):
+    """ Copies in kernel space with copy_file_range when it's available and
+    falls back to shutil, which uses sendfile on Linux.
+    """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                size = os.fstat(src_file.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    sent = os.copy_file_range(src_file.fileno(), dst_file.fileno(),
+                                              min(size - copied, 1 << 30))
+                    if not sent:
+                        break
+                    copied += sent
+            if copied == size:
+                return
+        except OSError:
+            pass
+    from shutil import copyfile
+    copyfile(src, dst)
+
+
+def temp_path(path):
+    """ A name next to path for a file to be renamed into place, unique to
+    the process and thread writing it
+    """
+    return '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+
+def atomic_write(path, data, sync=False):
+    """ Writes data (bytes) to a temp file and renames it into place, so
+    readers see either the old file or the new one, never a partial one.
+    With sync, the data is flushed to disk before the rename.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(data)
+            if sync:
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def sync_file(src, dst, digest, mode='copy'):
+    """ Puts a copy of src at dst, unless dst already has the same content.
+    The copy is made under a temporary name and renamed into place, so the
+    web server never serves a half-copied file. Returns how it was done.
+    """
+    if os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src) \
+            and file_digest(dst) == digest:
+        return 'skipped'
+
+    tmp = temp_path(dst)
+    methods = [('reflink', reflink_file), ('copy', zero_copy_file)]
+    if mode == 'hardlink':
+        methods.insert(0, ('hardlink', os.link))
+    try:
+        for (method, copy) in methods:
+            try:
+                copy(src, tmp)
+            except OSError:
+                if method == 'copy':
+                    raise
+                if os.path.isfile(tmp):
+                    os.remove(tmp)
+            else:
+                break
+        os.replace(tmp, dst)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+    return method
+
+
+# renameat2() flag swapping two paths in one step, and its current directory fd (Linux)
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def exchange_dirs(a, b):
+    """ Swaps two directories in one step with renameat2(RENAME_EXCHANGE)
+    where the kernel and libc have it. Elsewhere it takes three renames, with
+    a moment in between where b doesn't exist.
+    """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b),
+                          RENAME_EXCHANGE) == 0:
+            return
+    except (AttributeError, OSError):
+        pass
+    old = '%s.%d.old' % (b, os.getpid())
+    os.rename(b, old)
+    os.rename(a, b)
+    os.rename(old, a)
+
+
+def link_tree(src, dst):
+    """ Copies a directory tree with hardlinks, so the copy costs nothing
+    until its files are replaced (croissant always writes to a temp file and
+    renames it into place, so the files in src are never modified)
+    """
+    import shutil
+
+    def link(src_file, dst_file):
+        try:
+            os.link(src_file, dst_file)
+        except OSError:
+            shutil.copy2(src_file, dst_file)
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=link)
+
+
+# The most URLs a single sitemap file may list
+SITEMAP_URLS = 50000
+
+# Outputs worth keeping precompressed copies of
+COMPRESSIBLE = ('.html', '.xml', '.css', '.js', '.json', '.txt', '.svg', '.csv', '.md')
+
+
+def sidecars():
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return ('.gz',)
+    return ('.gz', '.br')
+
+
+def compress_file(path):
+    """ Writes .gz (and .br, when brotli is installed) siblings of a file
+    for web servers that serve precompressed files, like nginx's gzip_static.
+    """
+    with open(path, 'rb') as original:
+        data = original.read()
+    for ext in sidecars():
+        if ext == '.gz':
+            import gzip
+            compressed = gzip.compress(data, 9, mtime=0)
+        else:
+            import brotli
+            compressed = brotli.compress(data)
+        atomic_write(path + ext, compressed)
+
+
+def site_fingerprint(directories, files, snapshot=None, trees=()):
+    """ Digest of the directories' mtimes and of the name, size and mtime of
+    every entry in them (one scandir pass each), plus a few single files.
+    Trees are fingerprinted along with every directory under them.
+    When a FileSnapshot is given, the directories are read through it, so the
+    update that follows doesn't have to scan them again.
+    """
+    sha1 = hashlib.sha1()
+    # A stack, so subdirectories are taken right after their parent
+    pending = [(tree, True) for tree in reversed(trees)]
+    pending.extend((directory, False) for directory in reversed(directories))
+    while pending:
+        (directory, recurse) = pending.pop()
+        try:
+            sha1.update(('%s|%d\n' % (directory, os.stat(directory).st_mtime_ns)).encode('utf-8'))
+            if snapshot is None:
+                with os.scandir(directory) as entries:
+                    stats = [(entry.name, entry.stat(), entry.is_dir()) for entry in entries]
+            else:
+                stats = [(name, snapshot.stat(os.path.join(directory, name)),
+                          snapshot.isdir(os.path.join(directory, name)))
+                         for name in snapshot.listing(directory)]
+            listing = ['%s|%d|%d' % (name, stat.st_size, stat.st_mtime_ns)
+                       for (name, stat, _) in stats]
+        except OSError:
+            sha1.update(('%s|missing\n' % directory).encode('utf-8'))
+            continue
+        sha1.update('\n'.join(sorted(listing)).encode('utf-8'))
+        if recurse:
+            subdirectories = sorted(name for (name, _, is_dir) in stats if is_dir)
+            pending.extend((os.path.join(directory, name), True)
+                           for name in reversed(subdirectories))
+    for path in files:
+        try:
+            stat = os.stat(path)
+            sha1.update(('%s|%d|%d\n' % (path, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+        except OSError:
+            sha1.update(('%s|missing\n' % path).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def site_unchanged(root):
+    """ The fast path for frequent cron runs: compares the site against the
+    snapshot saved after the last update without parsing the configuration,
+    loading the state or importing any of the heavy modules.
+    """
+    try:
+        with open(os.path.join(root, 'cache', 'snapshot.json'), 'r') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        config = os.stat(os.path.join(root, 'config', 'config.yaml'))
+    except (IOError, ValueError):
+        return False
+    if snapshot.get('config') != [config.st_size, config.st_mtime_ns]:
+        return False
+    # Deleting the state is the way to re-render everything. Snapshots saved
+    # before the templates were fingerprinted recursively have no trees.
+    if not os.path.isfile(snapshot['state']) or 'trees' not in snapshot:
+        return False
+    sources = site_fingerprint(snapshot['directories'], [], trees=snapshot['trees'])
+    return (snapshot['sources'] == sources and
+            snapshot['outputs'] == site_fingerprint([], snapshot['files']))
+
+
+class FileSnapshot:
+    """ What is in the source and output directories during an update. Each
+    directory is read with a single os.scandir pass the first time it is
+    asked about, and every later check is answered from that listing: names
+    and file types come with the listing itself, and a file is only stat'ed
+    (once) when its size and mtime are needed. Croissant forgets the
+    directories it writes to, so they are read again if asked about later.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.listings = {}
+        self.statted = set()
+
+    def listing(self, directory):
+        directory = os.path.normpath(directory)
+        listing = self.listings.get(directory)
+        if listing is None:
+            listing = {}
+            self.stats.count('scandir calls')
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        listing[entry.name] = entry
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+            self.listings[directory] = listing
+        return listing
+
+    def entry(self, path):
+        (directory, name) = os.path.split(os.path.normpath(path))
+        return self.listing(directory).get(name)
+
+    def isfile(self, path):
+        entry = self.entry(path)
+        return entry is not None and entry.is_file()
+
+    def isdir(self, path):
+        entry = self.entry(path)
+        return entry is not None and entry.is_dir()
+
+    def files(self, directory):
+        return [name for (name, entry) in self.listing(directory).items() if entry.is_file()]
+
+    def stat(self, path):
+        """ Raises FileNotFoundError like os.stat, for files that weren't there
+        when their directory was read
+        """
+        entry = self.entry(path)
+        if entry is None:
+            raise FileNotFoundError(path)
+        # DirEntry keeps the result, so this is the only stat call for it
+        if entry.path not in self.statted:
+            self.stats.count('stat calls')
+            self.statted.add(entry.path)
+        return entry.stat()
+
+    def forget(self, path):
+        """ Drops the listings of the directories that contain path, after
+        croissant has written or removed something under it
+        """
+        directory = os.path.dirname(os.path.normpath(path))
+        while True:
+            self.listings.pop(directory, None)
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+
+
+class Stats:
+    """ Wall time and number of calls per phase, plus named counters (bytes
+    read and written, cache hits...). Phases nest, so their times are
+    inclusive.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            (calls, total) = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (calls + 1, total + time.perf_counter() - started)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def merge(self, other):
+        """ Adds up the as_dict() of another Stats, e.g. from a worker """
+        for phase, (calls, total) in other['phases'].items():
+            (own_calls, own_total) = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (own_calls + calls, own_total + total)
+        for counter, amount in other['counters'].items():
+            self.count(counter, amount)
+
+    def as_dict(self):
+        return {'phases': OrderedDict(self.phases), 'counters': OrderedDict(self.counters)}
+
+    def report(self):
+        lines = ['%-32s %8s %12s' % ('phase', 'calls', 'total (s)')]
+        for phase, (calls, total) in self.phases.items():
+            lines.append('%-32s %8d %12.4f' % (phase, calls, total))
+        lines.append('')
+        lines.append('%-32s %21s' % ('counter', 'value'))
+        for counter, amount in self.counters.items():
+            lines.append('%-32s %21s' % (counter, amount))
+        return '\n'.join(lines)
+
+
+def timed(phase):
+    """ Records the calls to a Croissant method as a phase of its stats """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.timer(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SourceFile:
+    """ A post or page source: a title underlined with three or more equals
+    signs, YAML frontmatter, an empty line and the body. Only the header is
+    read when the file is opened, and parsed once with yaml.safe_load; the
+    body is read from where the header ends the first time it's needed, so
+    finding out a post's date or slug doesn't mean reading all of it.
+
+    With whole=True the file is read in one go, for its digest. body_key is
+    the body's key in the body cache, when it's known.
+    """
+
+    def __init__(self, path, whole=False, body_key=None, digest=None):
+        self.path = path
+        self.body_key = body_key
+        self.digest = digest
+        self.body_text = None
+        with open(path, 'rb') as source:
+            if whole:
+                raw = source.read()
+                self.digest = hashlib.sha1(raw).hexdigest()
+                self.parse_header(io.BytesIO(raw))
+                self.body_text = self.decode(raw[self.body_offset:])
+                self.bytes_read = len(raw)
+            else:
+                self.parse_header(source)
+                self.bytes_read = self.body_offset
+
+    @staticmethod
+    def decode(data):
+        # Universal newlines, like reading in text mode
+        return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+    def parse_header(self, lines):
+        """ Everything up to the first empty line is the header, the body
+        starts after the empty lines that follow it
+        """
+        header = []
+        offset = 0
+        blank = False
+        for line in lines:
+            if not line.strip():
+                # Empty lines before the title are skipped
+                blank = bool(header)
+            elif blank:
+                break
+            else:
+                header.append(line)
+            offset += len(line)
+        if not blank:
+            raise ValueError('%s: no empty line after the frontmatter' % self.path)
+        self.body_offset = offset
+
+        header = self.decode(b''.join(header))
+        try:
+            (self.title, meta) = re.split('={3,}', header, 1)
+        except ValueError:
+            raise ValueError('%s: the title isn\'t underlined with ===' % self.path)
+        import yaml
+        self.meta = yaml.safe_load(meta) or {}
+
+    @property
+    def body(self):
+        if self.body_text is None:
+            with open(self.path, 'rb') as source:
+                source.seek(self.body_offset)
+                self.body_text = self.decode(source.read())
+        return self.body_text
+
+
+class MarkdownRenderer:
+    """ Python-Markdown. Building a Markdown instance sets up all of its
+    extensions, so one is kept per process and reset between bodies.
+    """
+
+    def __init__(self):
+        import markdown
+        # Part of the body cache salt
+        self.version = markdown.__version__
+        self.converter = markdown.Markdown(output_format='html5')
+
+    def render(self, text):
+        return self.converter.reset().convert(text)
+
+
+class MistuneRenderer:
+    """ mistune, a faster renderer written in pure Python. Its output differs
+    from Python-Markdown's in the details.
+    """
+
+    def __init__(self):
+        import mistune
+        self.version = 'mistune %s raw-html' % mistune.__version__
+        # Raw HTML passes through, like with Python-Markdown
+        self.converter = mistune.create_markdown(escape=False)
+
+    def render(self, text):
+        return self.converter(text)
+
+
+renderers = {
+    'markdown': MarkdownRenderer,
+    'mistune': MistuneRenderer,
+}
+
+# Bumped whenever croissant changes the HTML it makes out of a body
+BODY_FORMAT = 2
+
+# Links to media files in bodies point to ../media/, like in the source folder
+MEDIA_LINKS = re.compile(r""" (src|href)=["']\.\./media/([^/"']+?)["']""")
+
+
+class BodyCache:
+    """ On-disk cache of rendered post/page bodies, keyed by a digest of the
+    markdown source plus everything else that affects the rendered HTML.
+    """
+
+    def __init__(self, path, salt, stats):
+        self.path = path
+        self.salt = salt.encode('utf-8')
+        # Tells whether bodies were cached with the current settings
+        self.salt_id = hashlib.sha1(self.salt).hexdigest()[:12]
+        self.stats = stats
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def key(self, body):
+        return hashlib.sha1(self.salt + body.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, key + '.html'), 'r', encoding='utf-8') as cached:
+                html = cached.read()
+        except IOError:
+            self.stats.count('body cache misses')
+            return None
+        self.stats.count('body cache hits')
+        return html
+
+    def put(self, key, html):
+        # Written atomically so a concurrent reader never sees a partial entry
+        atomic_write(os.path.join(self.path, key + '.html'), html.encode('utf-8'))
+
+    def evict(self, key):
+        try:
+            os.remove(os.path.join(self.path, key + '.html'))
+        except OSError:
+            pass
+
+
+def encode_state(obj):
+    if isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def decode_state(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+class JSONStateStore:
+    """ Build state kept in one compact JSON file. The file is only rewritten
+    when a table has changed, through a temp file and an atomic rename, so a
+    crash never leaves it half written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self.dirty = set()
+        self.is_new = not os.path.isfile(self.path)
+        if not self.is_new:
+            with open(self.path, 'r') as state_file:
+                self.tables = json.load(state_file, object_hook=decode_state)
+
+    @staticmethod
+    def read(path):
+        """ The tables in a state file, read without writing anything """
+        if not os.path.isfile(path):
+            return {}
+        with open(path, 'r') as state_file:
+            return json.load(state_file, object_hook=decode_state)
+
+    def table(self, name):
+        return self.tables.setdefault(name, {})
+
+    def set(self, name, key, value):
+        self.table(name)[key] = value
+        self.dirty.add(name)
+
+    def delete(self, name, key):
+        self.table(name).pop(key, None)
+        self.dirty.add(name)
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = json.dumps(self.tables, default=encode_state, separators=(',', ':'))
+        atomic_write(self.path, data.encode('utf-8'), sync=True)
+        self.dirty = set()
+
+    def rollback(self):
+        """ Forgets the changes made since the last save """
+        self.tables = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as state_file:
+                self.tables = json.load(state_file, object_hook=decode_state)
+        self.dirty = set()
+
+    def close(self):
+        self.save()
+
+
+class SQLiteStateStore:
+    """ Build state kept in a SQLite database, one row per entry, so an
+    update only writes the entries that actually changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self.dirty = False
+        self.is_new = not os.path.isfile(self.path)
+        import sqlite3
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state ('
+                        'tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                        'PRIMARY KEY (tbl, key))')
+        self.db.commit()
+
+    @staticmethod
+    def read(path):
+        """ The tables in a state database, opened read-only """
+        if not os.path.isfile(path):
+            return {}
+        import sqlite3
+        from urllib.parse import quote
+        db = sqlite3.connect('file:%s?mode=ro' % quote(path), uri=True)
+        tables = {}
+        try:
+            for (name, key, value) in db.execute('SELECT tbl, key, value FROM state'):
+                tables.setdefault(name, {})[key] = json.loads(value, object_hook=decode_state)
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            db.close()
+        return tables
+
+    def table(self, name):
+        if name not in self.tables:
+            rows = self.db.execute('SELECT key, value FROM state WHERE tbl = ?', (name,))
+            self.tables[name] = dict(
+                (key, json.loads(value, object_hook=decode_state)) for key, value in rows)
+        return self.tables[name]
+
+    def set(self, name, key, value):
+        self.table(name)[key] = value
+        self.db.execute('INSERT OR REPLACE INTO state (tbl, key, value) VALUES (?, ?, ?)',
+                        (name, key, json.dumps(value, default=encode_state,
+                                               separators=(',', ':'))))
+        self.dirty = True
+
+    def delete(self, name, key):
+        self.table(name).pop(key, None)
+        self.db.execute('DELETE FROM state WHERE tbl = ? AND key = ?', (name, key))
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            self.db.commit()
+            self.dirty = False
+
+    def rollback(self):
+        self.db.rollback()
+        self.tables = {}
+        self.dirty = False
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+
+class MemoryStateStore(JSONStateStore):
+    """ State that lives in memory only, for Croissant instances that only
+    render: the render workers and the preview server
+    """
+
+    def __init__(self, tables):
+        self.path = None
+        self.tables = tables
+        self.dirty = set()
+        self.is_new = False
+
+    def save(self):
+        self.dirty = set()
+
+    def rollback(self):
+        self.dirty = set()
+
+
+state_backends = {
+    'json': ('state.json', JSONStateStore),
+    'sqlite': ('state.sqlite', SQLiteStateStore),
+}
+
+
+class SourceWatcher:
+    """ Polls a set of directories and reports which files changed. A burst of
+    changes is coalesced until nothing has changed for `debounce` seconds.
+    """
+
+    def __init__(self, paths, interval=1.0, debounce=2.0, ignore=()):
+        self.paths = paths
+        self.interval = interval
+        self.debounce = debounce
+        self.ignore = set(ignore)
+        self.last = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        pending = [path for path in self.paths if os.path.isdir(path)]
+        while pending:
+            path = pending.pop()
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name in self.ignore or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    else:
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue
+        return files
+
+    def changes(self, old, new):
+        changed = set(path for path in new if old.get(path) != new[path])
+        changed.update(path for path in old if path not in new)
+        return changed
+
+    def wait(self):
+        """ Blocks until something changed and then settled down (or, without
+        a debounce, until something changed at all). Anything that changes
+        while the caller is busy building is picked up by the next call, since
+        the snapshot is only advanced here.
+        """
+        changed = set()
+        last_change = 0
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            new_changes = self.changes(self.last, current)
+            self.last = current
+            if new_changes:
+                changed.update(new_changes)
+                last_change = time.time()
+                if not self.debounce:
+                    return changed
+            elif changed and time.time() - last_change >= self.debounce:
+                return changed
+
+
+class PostIndex:
+    """ Published posts as [published, post] pairs in date order, kept in the
+    state store and updated one post at a time instead of re-sorting all the
+    posts on every update. Changes, and a missing or outdated index rebuilt
+    in memory, only mark it dirty: the update saves it once along with the
+    rest of the state, and render workers, which build one too, never do.
+    """
+
+    def __init__(self, state, posts):
+        self.state = state
+        self.entries = state.table('index').get('published')
+        published = [post for post in posts.items() if not post[1]['draft']]
+        self.dirty = self.entries is None or len(self.entries) != len(published)
+        if self.dirty:
+            self.entries = sorted([entry['published'], post] for (post, entry) in published)
+
+    def save(self):
+        self.state.set('index', 'published', self.entries)
+        self.dirty = False
+
+    def remove(self, post):
+        for position, (_, name) in enumerate(self.entries):
+            if name == post:
+                del self.entries[position]
+                self.dirty = True
+                return
+
+    def update(self, post, entry):
+        self.remove(post)
+        if not entry['draft']:
+            bisect.insort(self.entries, [entry['published'], post])
+            self.dirty = True
+
+    def neighbors(self, post, published):
+        """ The published posts right before and after a post, None at either end """
+        position = bisect.bisect_left(self.entries, [published, post])
+        if position == len(self.entries) or self.entries[position][1] != post:
+            return (None, None)
+        older = self.entries[position - 1][1] if position > 0 else None
+        newer = self.entries[position + 1][1] if position + 1 < len(self.entries) else None
+        return (older, newer)
+
+    def newest(self, count=None):
+        if count is None:
+            count = len(self.entries)
+        return [post for (_, post) in reversed(self.entries[-count:])] if count else []
+
+
+class SearchIndex:
+    """ The terms of every published post, kept in cache/search.json, from
+    which croissant builds a client-side search index in the webroot:
+
+    - search/docs.json lists the posts as [title, uri], a post's id being its
+      position in the list (removed posts leave a null behind)
+    - search/<prefix>.json maps every term starting with a two character
+      prefix to the ids of the posts that contain it, title matches first
+
+    Posts are tokenized once, when they are rendered, and only the shards
+    whose terms changed are built again. Ids are handed out from next_id, or
+    from the free ids of removed posts (a heap, smallest first) so docs.json
+    doesn't keep growing with nulls. The shards still to be written are
+    kept in the cache file too, flagged in the state, so they aren't lost if
+    croissant stops before writing them. The cache file is only read when a
+    post was added, changed or removed, or shards are left to write.
+    """
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.data = None
+        self.unsaved = False
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        if self.data is None:
+            try:
+                with open(self.path, 'r') as index_file:
+                    self.data = json.load(index_file)
+            except (IOError, ValueError):
+                self.data = {'posts': {}, 'dirty': [], 'docs_dirty': False,
+                             'next_id': 0, 'free': []}
+            if 'next_id' not in self.data:
+                # Saved by a version that looked for a free id every time
+                used = set(entry['id'] for entry in self.data['posts'].values())
+                self.data['next_id'] = max(used) + 1 if used else 0
+                self.data['free'] = [number for number in range(self.data['next_id'])
+                                     if number not in used]
+        return self.data
+
+    @staticmethod
+    def tokenize(text):
+        import html
+        text = html.unescape(re.sub(r'<[^>]+>', ' ', text)).lower()
+        return set(term for term in re.findall(r'\w{2,}', text) if len(term) <= 32)
+
+    @staticmethod
+    def shard(term):
+        return term[:2]
+
+    def mark(self, terms, docs=False):
+        data = self.load()
+        data['dirty'] = sorted(set(data['dirty']) | set(self.shard(term) for term in terms))
+        data['docs_dirty'] = data['docs_dirty'] or docs
+        self.unsaved = True
+        self.state.set('search', 'pending', True)
+
+    def add(self, post, title, uri, body_html):
+        data = self.load()
+        posts = data['posts']
+        title_terms = self.tokenize(title)
+        body_terms = self.tokenize(body_html) - title_terms
+        previous = posts.get(post)
+        if previous is None:
+            if data['free']:
+                post_id = heapq.heappop(data['free'])
+            else:
+                post_id = data['next_id']
+                data['next_id'] += 1
+            previous = {'id': post_id, 'title': None, 'uri': None,
+                        'title_terms': [], 'body_terms': []}
+        entry = {
+            'id': previous['id'],
+            'title': title,
+            'uri': uri,
+            'title_terms': sorted(title_terms),
+            'body_terms': sorted(body_terms)
+        }
+        if entry == previous:
+            return
+        # A term that moved between the title and the body changes its shard too
+        old = set(('title', term) for term in previous['title_terms']) | \
+            set(('body', term) for term in previous['body_terms'])
+        new = set(('title', term) for term in title_terms) | \
+            set(('body', term) for term in body_terms)
+        self.mark([term for (_, term) in old ^ new],
+                  (previous['title'], previous['uri']) != (title, uri))
+        posts[post] = entry
+
+    def mark_all(self):
+        posts = self.load()['posts']
+        self.mark([term for entry in posts.values()
+                   for term in entry['title_terms'] + entry['body_terms']], True)
+
+    def remove(self, post):
+        if self.data is None and not self.exists():
+            return
+        data = self.load()
+        entry = data['posts'].pop(post, None)
+        if entry:
+            heapq.heappush(data['free'], entry['id'])
+            self.mark(entry['title_terms'] + entry['body_terms'], True)
+
+    def pending(self):
+        """ The shards that have to be written again, and whether docs.json does """
+        if self.data is None and not self.state.table('search').get('pending'):
+            return ([], False)
+        return (self.load()['dirty'], self.load()['docs_dirty'])
+
+    def docs(self):
+        posts = self.load()['posts']
+        docs = [None] * (max([entry['id'] for entry in posts.values()] or [-1]) + 1)
+        for entry in posts.values():
+            docs[entry['id']] = [entry['title'], entry['uri']]
+        return docs
+
+    def shards(self, names):
+        """ The content of the given shards, in one pass over the posts' terms.
+        Shards left without terms come back empty.
+        """
+        shards = dict((name, {}) for name in names)
+        for entry in sorted(self.load()['posts'].values(), key=lambda entry: entry['id']):
+            for (position, field) in enumerate(('title_terms', 'body_terms')):
+                for term in entry[field]:
+                    if self.shard(term) in shards:
+                        shards[self.shard(term)].setdefault(term, [[], []])[position] \
+                            .append(entry['id'])
+        return dict((name, dict((term, title + body) for (term, (title, body)) in terms.items()))
+                    for (name, terms) in shards.items())
+
+    def written(self):
+        data = self.load()
+        data['dirty'] = []
+        data['docs_dirty'] = False
+        self.unsaved = True
+        self.state.set('search', 'pending', False)
+
+    def save(self):
+        if not self.unsaved:
+            return
+        data = json.dumps(self.data, separators=(',', ':'))
+        atomic_write(self.path, data.encode('utf-8'))
+        self.unsaved = False
+
+
+class LazyPost:
+    """ A post as the homepage, archive and feed templates see it. Its rendered
+    body is only fetched (from the body cache, usually) when the template gets
+    to it, and isn't kept, so streaming a long page holds one body at a time.
+    """
+
+    def __init__(self, croissant, post):
+        self.croissant = croissant
+        self.post = post
+        entry = croissant.posts[post]
+        date = entry['published']
+        self.title = entry['title']
+        self.date = date
+        self.link = entry['link']
+        self.uri = croissant.post_uri(entry)
+        self.url = croissant.post_url(entry)
+
+    @property
+    def body(self):
+        try:
+            return self.croissant.get_post_body(self.post)
+        except (IOError, ValueError) as error:
+            print(error)
+            return ''
+
+
 class Croissant:
 
-    def __init__(self, root):
+    def __init__(self, root, pool=None, state=None):
+        """ An instance given a state store instead of the site's own only
+        renders, and leaves the site's directories and state alone
+        """
+        self.root = root
+        self.stats = Stats()
         config_path = os.path.join(root, 'config/')
+        self.config_path = config_path
         self.templates_path = os.path.join(root, 'templates/')
-        self.posts = {}
-        self.rendered_posts = os.path.join(config_path, 'rendered_posts.yaml')
-        self.pages = {}
-        self.rendered_pages = os.path.join(config_path, 'rendered_pages.yaml')
-        self.media = {}
-        self.moved_media = os.path.join(config_path, 'moved_media.yaml')
         config = self.load_config(config_path)
+        self.state_backend = config.get('state_backend', 'json')
+        if state is None:
+            self.state = self.load_state(config_path, self.state_backend)
+        else:
+            self.state = state
+        self.posts = self.state.table('posts')
+        self.pages = self.state.table('pages')
+        self.media = self.state.table('media')
+        self.index = PostIndex(self.state, self.posts)
+        # Every file croissant has written, and which source it came from
+        self.manifest = self.state.table('manifest')
+        self.output_sources = None
 
         blog = config['blog']
         if not blog['url'].endswith('/'):
@@ -41,25 +1013,60 @@ class Croissant:
 
         self.blog_url = blog['url']
         self.posts_in_homepage = config['posts_in_homepage']
+        self.homepage_pages = config.get('homepage_pages', 1)
+        self.archive_by_month = config.get('archive_by_month', False)
+        self.feeds = config.get('feeds', ['year', 'tag'])
         self.rss_posts = 20
         self.source_path = config['source_path']
         self.posts_path = os.path.join(self.source_path, 'posts/')
         self.pages_path = os.path.join(self.source_path, 'pages/')
         self.media_path = os.path.join(self.source_path, 'media/')
 
-        self.webroot = config['webroot']
         self.public_drafts = config['public_drafts']
-        if self.public_drafts:
-            self.drafts_output = os.path.join(self.webroot, 'drafts/')
-        else:
-            self.drafts_output = os.path.join(self.source_path, 'drafts/')
-
-        self.chk_dirs()
-
-        self.env = Environment(loader=FileSystemLoader(self.templates_path))
+        self.use_webroot(config['webroot'])
+
+        # Number of processes used to render posts and pages
+        self.workers = config.get('workers') or os.cpu_count() or 1
+        self.pool = pool
+        self.owns_pool = False
+
+        # Threads used to copy media files, and whether copies may be hardlinks
+        self.media_workers = config.get('media_workers', 4)
+        self.media_sync = config.get('media_sync', 'copy')
+        self.precompress = config.get('precompress', False)
+
+        if state is None:
+            self.chk_dirs()
+
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+        self.cache_path = os.path.join(root, 'cache/')
+        # Compiled templates are kept across runs and worker processes; Jinja
+        # checks them against a checksum of the template source
+        templates_cache = os.path.join(self.cache_path, 'templates/')
+        if not os.path.isdir(templates_cache):
+            os.makedirs(templates_cache, exist_ok=True)
+        self.env = Environment(loader=FileSystemLoader(self.templates_path),
+                               bytecode_cache=FileSystemBytecodeCache(templates_cache))
         self.env.globals['blog'] = blog
 
-        self.updated_posts = False
+        renderer = config.get('markdown_renderer', 'markdown')
+        if renderer not in renderers:
+            sys.exit('Unknown markdown renderer: %s' % renderer)
+        self.renderer = renderers[renderer]()
+        # Anything that changes the rendered HTML of a body goes in the salt
+        self.body_cache = BodyCache(
+            os.path.join(self.cache_path, 'bodies/'),
+            '%s|html5|%s|%d' % (self.renderer.version, self.blog_url, BODY_FORMAT),
+            self.stats)
+        self.search = SearchIndex(os.path.join(self.cache_path, 'search.json'), self.state)
+
+        self.snapshot = FileSnapshot(self.stats)
+        self.touched = {'posts': [], 'pages': [], 'media': []}
+        self.template_digests = {}
+        # What --rebuild is re-rendering into a staging webroot
+        self.rebuilding = set()
+        # Outputs by path, when rendering into memory for the preview server
+        self.capture = None
 
     def chk_dirs(self):
         if not os.path.isdir(self.source_path):
@@ -78,306 +1085,819 @@ class Croissant:
             print('Creating webroot')
             os.makedirs(self.webroot)
 
-    def store_rendered_files(self, destination, dictionary):
-        with open(destination, 'w') as yaml_file:
-            yaml.dump(dictionary, yaml_file, default_flow_style=False)
+    def watched_paths(self):
+        return [self.posts_path, self.pages_path, self.media_path,
+                self.templates_path, self.config_path]
+
+    def state_files(self):
+        """ Files croissant writes itself, which watch mode has to ignore """
+        names = []
+        for (filename, _) in state_backends.values():
+            names.extend([filename, filename + '-wal', filename + '-shm',
+                          filename + '-journal'])
+        return names
+
+    @timed('store state')
+    def store_rendered_files(self):
+        # A rebuild's state only describes the live site once it's swapped in
+        if not self.rebuilding:
+            # The search terms go first: if croissant stops in between, the
+            # posts are rendered and indexed again next time
+            self.search.save()
+            if self.index.dirty:
+                self.index.save()
+            self.state.save()
+
+    def use_webroot(self, webroot):
+        self.webroot = webroot
+        if self.public_drafts:
+            self.drafts_output = os.path.join(self.webroot, 'drafts/')
+        else:
+            self.drafts_output = os.path.join(self.source_path, 'drafts/')
 
+    @timed('load config')
     def load_config(self, config_path):
-        try:
-            with open(self.rendered_posts, 'r') as posts_dict:
-                self.posts = yaml.load(posts_dict)
-
-                """ Creating new dict if YAML file is empty to prevent self.posts
-                from becoming 'NoneType' object
-                """
-                if not self.posts:
-                    self.posts = {}
-        except IOError as error:
-            print(error)
-            print('Creating new rendered posts YAML file.')
-            f = open(self.rendered_posts, 'w')
-            f.close()
-
-        try:
-            with open(self.rendered_pages, 'r') as pages_dict:
-                self.pages = yaml.load(pages_dict)
-
-                if not self.pages:
-                    self.pages = {}
-        except IOError as error:
-            print(error)
-            print('Creating new rendered pages YAML file.')
-            f = open(self.rendered_pages, 'w')
-            f.close()
-
-        try:
-            with open(self.moved_media, 'r') as media_dict:
-                self.media = yaml.load(media_dict)
-
-                if not self.media:
-                    self.media = {}
-        except IOError as error:
-            print(error)
-            print('Creating new moved media YAML file.')
-            f = open(self.moved_media, 'w')
-            f.close()
-
+        import yaml
         try:
             with open(os.path.join(config_path, 'config.yaml'), 'r') as config:
-                config = yaml.load(config)
+                config = yaml.safe_load(config)
         except IOError as error:
             print(error)
             sys.exit('Please provide configuration file')
         else:
             return config
 
+    @timed('load state')
+    def load_state(self, config_path, backend):
+        import yaml
+        if backend not in state_backends:
+            sys.exit('Unknown state backend: %s' % backend)
+        (filename, store_class) = state_backends[backend]
+        state = store_class(os.path.join(config_path, filename))
+
+        if state.is_new:
+            """ Importing the YAML files used by older versions of croissant.
+            This only happens once, when the state store is first created.
+            """
+            legacy_files = (('posts', 'rendered_posts.yaml'),
+                            ('pages', 'rendered_pages.yaml'),
+                            ('media', 'moved_media.yaml'))
+            imported = []
+            for (name, filename) in legacy_files:
+                legacy_path = os.path.join(config_path, filename)
+                try:
+                    with open(legacy_path, 'r') as yaml_file:
+                        entries = yaml.safe_load(yaml_file)
+                except IOError:
+                    continue
+                for key, value in (entries or {}).items():
+                    state.set(name, key, value)
+                imported.append(legacy_path)
+                print('Imported %s into the state store' % filename)
+            state.save()
+
+            # Renamed so deleting the state store later doesn't import them again
+            for legacy_path in imported:
+                os.rename(legacy_path, legacy_path + '.imported')
+
+        return state
+
+    def fingerprint_paths(self):
+        """ What the fast path looks at: the source directories, the templates
+        directory with its subdirectories (for partials and the like), and the
+        top level outputs, so a wiped webroot is still noticed. Outputs
+        deleted deeper in the webroot are only noticed by a full run.
+        """
+        directories = [self.posts_path, self.pages_path, self.media_path]
+        trees = [self.templates_path]
+        files = [os.path.join(self.webroot, 'index.html'),
+                 os.path.join(self.webroot, 'rss.xml'),
+                 os.path.join(self.webroot, 'archive/', 'index.html')]
+        return (directories, trees, files)
+
+    def save_snapshot(self, sources):
+        """ The sources are fingerprinted before anything is checked, so any
+        change made while updating makes the next run a full one; the outputs
+        are fingerprinted after they have been written.
+        """
+        (directories, trees, files) = self.fingerprint_paths()
+        config = os.stat(os.path.join(self.config_path, 'config.yaml'))
+        snapshot = {
+            'config': [config.st_size, config.st_mtime_ns],
+            'state': self.state.path,
+            'directories': directories,
+            'trees': trees,
+            'files': files,
+            'sources': sources,
+            'outputs': site_fingerprint([], files),
+            # How long the update took, for run_sites to schedule by
+            'seconds': round(time.perf_counter() - self.started, 3)
+        }
+        atomic_write(os.path.join(self.cache_path, 'snapshot.json'),
+                     json.dumps(snapshot).encode('utf-8'))
+
+    @timed('update')
     def update(self):
+        self.started = time.perf_counter()
+        # One scandir pass per source directory, shared by the fingerprint
+        # and all the checks below
+        self.snapshot = FileSnapshot(self.stats)
+        self.template_digests = {}
+        with self.stats.timer('fingerprint'):
+            (directories, trees, _) = self.fingerprint_paths()
+            sources = site_fingerprint(directories, [], self.snapshot, trees)
+        # Files whose mtime changed but whose content didn't, in this update
+        self.touched = {'posts': [], 'pages': [], 'media': []}
         self.check_for_updated_posts()
         self.check_for_updated_pages()
         self.check_for_updated_media()
 
-        home_exists = os.path.isfile(os.path.join(self.webroot, 'index.html'))
-        rss_exists = os.path.isfile(os.path.join(self.webroot, 'rss.xml'))
-        archive_exists = os.path.isfile(os.path.join(self.webroot, 'archive/', 'index.html'))
-
-        if self.updated_posts or not home_exists:
-            self.render_homepage()
-        if self.updated_posts or not rss_exists:
-            self.render_rss()
-        if self.updated_posts or not archive_exists:
-            self.render_archive()
-
-    def check_for_updated_posts(self):
-        for post in os.listdir(self.posts_path):
+        self.render_aggregates()
+        self.write_search_index()
+        self.clean_orphans()
+        if self.precompress:
+            self.compress_outputs()
+
+        self.store_rendered_files()
+        if not self.rebuilding:
+            self.save_snapshot(sources)
+
+    def rebuild(self, kinds):
+        """ Re-renders every post, page and/or media file, keeping the dates
+        and slugs in the state, into a staging copy of the webroot (made with
+        hardlinks) that is then swapped with the live one, so the site is
+        never seen half built.
+        """
+        import shutil
+        live = os.path.realpath(self.webroot)
+        staging = live + '.staging'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        print('Staging the webroot in', staging)
+        link_tree(live, staging)
+
+        self.rebuilding = set(kinds)
+        self.use_webroot(staging + os.sep)
+        try:
+            if 'media' in kinds:
+                shutil.rmtree(os.path.join(staging, 'media'), ignore_errors=True)
+            if 'posts' in kinds:
+                # The homepage, feed, archive and search index are built from the posts
+                for output in list(self.state.table('outputs')):
+                    self.state.delete('outputs', output)
+                self.search.mark_all()
+            self.update()
+        except BaseException:
+            self.state.rollback()
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        finally:
+            self.rebuilding = set()
+            self.use_webroot(os.path.join(live, ''))
+
+        exchange_dirs(staging, live)
+        print('Swapped the rebuilt site in')
+        self.store_rendered_files()
+        # The old site is what's in the staging directory now
+        shutil.rmtree(staging)
+        # Whatever changed while rebuilding is picked up by the next update
+        try:
+            os.remove(os.path.join(self.cache_path, 'snapshot.json'))
+        except OSError:
+            pass
+
+    def plan_posts(self):
+        """ Works out what has to happen to every post before anything is
+        rendered, so the rendering itself can be handed to the worker pool.
+        """
+        plan = {'new': [], 'moved': [], 'updated': [], 'deleted': [],
+                'rerender': [], 'reason': None}
+        for post in self.snapshot.files(self.posts_path):
             ext = os.path.splitext(post)[-1].lower()
             if ext == '.md' or ext == '.markdown' or ext == '.txt':
                 if post not in self.posts:
-                    print('New post found:', post)
-                    self.add_post(post, new=True)
+                    plan['new'].append(post)
                 elif not self.is_post_rendered(post) and not self.posts[post]['draft']:
-                    print('Post \'%s\' has been previously rendered but was '\
-                          'not found in site directory' % post)
-                    self.add_post(post)
-                else:
-                    post_updated = self.posts[post]['mod'] \
-                        < os.path.getmtime(os.path.join(self.posts_path, post))
-                    if post_updated:
-                        print('Post to update:', post)
-                        self.add_post(post)
-
-        for post in list(self.posts.keys()):
-            if not os.path.isfile(os.path.join(self.posts_path, post)):
-                print('Deleting post:', post)
-                self.remove_post(post)
-                self.updated_posts = True
-                del self.posts[post]
-                print('Done')
+                    plan['moved'].append(post)
+                elif self.source_status('posts', post, self.posts_path) == 'changed':
+                    plan['updated'].append(post)
 
-        self.store_rendered_files(self.rendered_posts, self.posts)
+        for post in self.posts:
+            if not self.snapshot.isfile(os.path.join(self.posts_path, post)):
+                plan['deleted'].append(post)
 
-    def check_for_updated_pages(self):
-        for page in os.listdir(self.pages_path):
+        plan['reason'] = self.rerender_reason('posts', 'post.html')
+        if plan['reason']:
+            planned = set(plan['new'] + plan['moved'] + plan['updated'] + plan['deleted'])
+            plan['rerender'] = [post for post in self.posts if post not in planned]
+
+        return plan
+
+    @timed('check posts')
+    def check_for_updated_posts(self):
+        plan = self.plan_posts()
+
+        """ Deletions go first, so a post that was renamed in the source
+        directory but kept its slug isn't removed right after being rendered.
+        """
+        for post in plan['deleted']:
+            print('Deleting post:', post)
+            self.remove_post(post)
+            self.body_cache.evict(self.posts[post].get('body', ''))
+            self.state.delete('posts', post)
+            self.index.remove(post)
+            self.search.remove(post)
+            print('Done')
+
+        if self.posts and not self.search.exists() and 'posts' not in self.rebuilding:
+            self.build_search_index(plan['new'] + plan['moved'] + plan['updated'])
+
+        jobs = []
+        for post in plan['new']:
+            print('New post found:', post)
+            jobs.append(self.add_post(post, new=True, render=False))
+        for post in plan['moved']:
+            print('Post \'%s\' has been previously rendered but was '\
+                  'not found in site directory' % post)
+            jobs.append(self.add_post(post, render=False))
+        for post in plan['updated']:
+            print('Post to update:', post)
+            jobs.append(self.add_post(post, render=False))
+        if plan['rerender']:
+            print('%s, re-rendering %d post(s)' % (plan['reason'], len(plan['rerender'])))
+            jobs.extend(self.add_post(post, render=False) for post in plan['rerender'])
+        jobs = [job for job in jobs if job]
+        if jobs or plan['deleted']:
+            jobs.extend(self.neighbor_jobs(set(job[0] for job in jobs)))
+        for (post, meta, _) in jobs:
+            self.set_neighbors(post, meta)
+
+        self.run_jobs('post', jobs)
+        self.record_template('posts', self.template_digest('post.html'))
+        self.record_template('posts settings', self.body_cache.salt_id)
+
+        self.store_rendered_files()
+
+    def plan_pages(self):
+        plan = {'new': [], 'moved': [], 'updated': [], 'deleted': [],
+                'rerender': [], 'reason': None}
+        for page in self.snapshot.files(self.pages_path):
             ext = os.path.splitext(page)[-1].lower()
             if ext == '.md' or ext == '.markdown' or ext == '.txt':
                 if page not in self.pages:
-                    print('New page found:', page)
-                    self.add_page(page, new=True)
+                    plan['new'].append(page)
                 elif not self.is_page_rendered(page):
-                    print('Page \'%s\' has been previously rendered but was ' \
-                          'not found in site directory' % page)
-                    self.add_page(page)
-                else:
-                    page_updated = self.pages[page]['mod'] \
-                        < os.path.getmtime(os.path.join(self.pages_path, page))
-                    if page_updated:
-                        print('Page to update:', page)
-                        self.add_page(page)
-
-        for page in list(self.pages.keys()):
-            if not os.path.isfile(os.path.join(self.pages_path, page)):
-                print('Deleting page:', page)
-                self.remove_page(page)
-                del self.pages[page]
-                print('Done')
+                    plan['moved'].append(page)
+                elif self.source_status('pages', page, self.pages_path) == 'changed':
+                    plan['updated'].append(page)
 
-        self.store_rendered_files(self.rendered_pages, self.pages)
+        for page in self.pages:
+            if not self.snapshot.isfile(os.path.join(self.pages_path, page)):
+                plan['deleted'].append(page)
 
+        plan['reason'] = self.rerender_reason('pages', 'page.html')
+        if plan['reason']:
+            planned = set(plan['new'] + plan['moved'] + plan['updated'] + plan['deleted'])
+            plan['rerender'] = [page for page in self.pages if page not in planned]
+
+        return plan
+
+    @timed('check pages')
+    def check_for_updated_pages(self):
+        plan = self.plan_pages()
+
+        for page in plan['deleted']:
+            print('Deleting page:', page)
+            self.remove_page(page)
+            self.body_cache.evict(self.pages[page].get('body', ''))
+            self.state.delete('pages', page)
+            print('Done')
+
+        jobs = []
+        for page in plan['new']:
+            print('New page found:', page)
+            jobs.append(self.add_page(page, new=True, render=False))
+        for page in plan['moved']:
+            print('Page \'%s\' has been previously rendered but was ' \
+                  'not found in site directory' % page)
+            jobs.append(self.add_page(page, render=False))
+        for page in plan['updated']:
+            print('Page to update:', page)
+            jobs.append(self.add_page(page, render=False))
+        if plan['rerender']:
+            print('%s, re-rendering %d page(s)' % (plan['reason'], len(plan['rerender'])))
+            jobs.extend(self.add_page(page, render=False) for page in plan['rerender'])
+
+        self.run_jobs('page', [job for job in jobs if job])
+        self.record_template('pages', self.template_digest('page.html'))
+        self.record_template('pages settings', self.body_cache.salt_id)
+
+        self.store_rendered_files()
+
+    def template_digest(self, name):
+        """ Digest of a template along with every template it extends, includes
+        or imports. The references are only parsed again when the template's
+        own source changes.
+        """
+        if name in self.template_digests:
+            return self.template_digests[name]
+        # Stops a template that ends up referencing itself from recursing forever
+        self.template_digests[name] = ''
+
+        (source, _, _) = self.env.loader.get_source(self.env, name)
+        source_digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        known = self.state.table('template_sources').get(name)
+        if known and known['digest'] == source_digest:
+            references = known['references']
+        else:
+            from jinja2 import meta
+            # Names only known when rendering come back as None
+            references = sorted(set(reference for reference
+                                    in meta.find_referenced_templates(self.env.parse(source))
+                                    if reference))
+            self.state.set('template_sources', name,
+                           {'digest': source_digest, 'references': references})
+
+        sha1 = hashlib.sha1(source_digest.encode('utf-8'))
+        for reference in references:
+            sha1.update(('%s|%s\n' % (reference, self.template_digest(reference))).encode('utf-8'))
+        self.template_digests[name] = sha1.hexdigest()
+        return self.template_digests[name]
+
+    def record_template(self, key, value):
+        """ Only writes to the state when the value changed, so an update with
+        nothing to do doesn't rewrite it
+        """
+        if self.state.table('templates').get(key) != value:
+            self.state.set('templates', key, value)
+
+    def rerender_reason(self, kind, name):
+        """ Why all the posts or pages have to be rendered again, if they do:
+        a rebuild, or they were last rendered with a different version of
+        their template (or of one it builds on)
+        """
+        table = self.posts if kind == 'posts' else self.pages
+        if not table:
+            return None
+        if kind in self.rebuilding:
+            return 'Rebuilding'
+        if self.state.table('templates').get(kind) != self.template_digest(name):
+            return 'Template %s has changed' % name
+        settings = self.state.table('templates').get(kind + ' settings')
+        if settings is not None and settings != self.body_cache.salt_id:
+            return 'The markdown renderer or the blog URL has changed'
+        return None
+
+    def get_pool(self):
+        if self.pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            self.owns_pool = True
+        return self.pool
+
+    def close(self):
+        if self.pool is not None and self.owns_pool:
+            self.pool.shutdown()
+            self.pool = None
+        self.state.close()
+
+    def run_jobs(self, kind, jobs):
+        """ Renders the (name, meta, source) jobs returned by add_post/add_page,
+        across the worker pool when there's more than one of them.
+        """
+        if kind == 'post':
+            done_msg = 'Rendered:'
+        else:
+            done_msg = 'Rendered page:'
+
+        # Workers only render; outputs are written from here so the manifest
+        # stays in one place
+        if self.workers > 1 and len(jobs) > 1:
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+            rendered = self.get_pool().map(
+                render_job,
+                [self.root] * len(jobs),
+                [self.webroot] * len(jobs),
+                [kind] * len(jobs),
+                [job[1] for job in jobs],
+                [job[2] for job in jobs],
+                chunksize=chunksize)
+        elif kind == 'post':
+            rendered = (self.build_post(meta, source) for (_, meta, source) in jobs)
+        else:
+            rendered = (self.build_page(meta, source) for (_, meta, source) in jobs)
+
+        for (name, meta, source), result in zip(jobs, rendered):
+            (path, html) = result[:2]
+            if len(result) > 2:
+                self.stats.merge(result[2])
+            self.write_output(path, html, '%ss/%s' % (kind, name))
+            if kind == 'post':
+                self.index_post(name, meta, source)
+            print(done_msg, name)
+
+    @timed('check media')
     def check_for_updated_media(self):
-        for data_file in os.listdir(self.media_path):
+        to_sync = []
+        for data_file in self.snapshot.files(self.media_path):
             # This is for macOS
             if data_file != '.DS_Store':
                 if data_file not in self.media:
                     print('New file found: ', data_file)
-                    self.add_file(data_file)
+                    to_sync.append(data_file)
+                elif 'media' in self.rebuilding:
+                    to_sync.append(data_file)
                 elif not self.is_file_moved(data_file):
                     print('File \'%s\' has been previously moved but was not found' \
                           ' in site directory' % data_file)
-                    self.add_file(data_file)
-                else:
-                    file_updated = self.media[data_file]['mod'] \
-                        < os.path.getmtime(os.path.join(self.media_path, data_file))
-                    if file_updated:
-                        print('File to update: ', data_file)
-                        self.add_file(data_file)
+                    to_sync.append(data_file)
+                elif self.source_status('media', data_file, self.media_path) == 'changed':
+                    print('File to update: ', data_file)
+                    to_sync.append(data_file)
 
         for data_file in list(self.media.keys()):
-            if not os.path.isfile(os.path.join(self.media_path, data_file)):
+            if not self.snapshot.isfile(os.path.join(self.media_path, data_file)):
                 print('Deleting file: ', data_file)
                 self.remove_file(data_file)
-                del self.media[data_file]
+                self.state.delete('media', data_file)
                 print('Done')
 
-        self.store_rendered_files(self.moved_media, self.media)
-
-    def add_post(self, post, new=False):
-        self.updated_posts = True
-        mod_time = os.path.getmtime(os.path.join(self.posts_path, post))
-        try:
-            with open(os.path.join(self.posts_path, post), 'r') as source:
-                txt = source.read()
-                try:
-                    (meta, body) = re.split('\n{2,}', txt, 1)
-                    (title, meta) = re.split('={3,}', meta, 1)
-                except ValueError as error:
-                    print(error)
+        if 'media' in self.rebuilding:
+            print('Rebuilding, copying %d media file(s)' % len(to_sync))
+        self.sync_media(to_sync)
+
+        self.store_rendered_files()
+
+    @timed('sync media')
+    def sync_media(self, data_files):
+        """ Copies media files to the webroot on a bounded thread pool. Hashing
+        and copying mostly happen outside the GIL, and the state is only
+        updated from this thread.
+        """
+        if not data_files:
+            return
+        if not os.path.isdir(os.path.join(self.webroot, 'media/')):
+            os.makedirs(os.path.join(self.webroot, 'media/'))
+
+        if self.media_workers > 1 and len(data_files) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.media_workers) as pool:
+                synced = list(pool.map(self.copy_file, data_files))
+        else:
+            synced = [self.copy_file(data_file) for data_file in data_files]
+
+        for (data_file, entry, method) in synced:
+            if entry:
+                self.snapshot.forget(os.path.join(self.webroot, 'media/', data_file))
+                self.state.set('media', data_file, entry)
+                self.record_output(
+                    self.output_key(os.path.join(self.webroot, 'media/', data_file)),
+                    entry['digest'], entry['size'], 'media/' + data_file)
+                if method == 'skipped':
+                    print('File already in place: ', data_file)
                 else:
-                    if yaml.load(meta):
-                        meta = yaml.load(meta)
-                    else:
-                        meta = {}
-                    meta = self.set_post_meta(meta, title, post, new)
-
-                    if not new:
-                        if self.posts[post]['slug'] != meta['slug']:
-                            post_path = self.is_post_rendered(post)
-                            if post_path:
-                                parent_path = os.path.split(os.path.dirname(post_path))[0]
-                                new_path = os.path.join(parent_path, meta['slug'])
-                                os.rename(post_path, new_path)
-
-                        if self.posts[post]['published'] != meta['date']:
-                            self.remove_post(post)
-
-                        if self.posts[post]['draft'] != meta['draft']:
-                            if meta['draft']:
-                                self.remove_post(post)
-                            else:
-                                self.remove_draft(post)
-
-                    self.posts[post] = {
-                        'mod': int(mod_time),
-                        'published': meta['date'],
-                        'title': meta['title'],
-                        'slug': meta['slug'],
-                        'link': meta['link'],
-                        'draft': meta['draft']
-                    }
-
-                    self.render_post(meta, body)
-
-                    print('Rendered:', post)
-        except IOError as error:
-            print(error)
+                    self.stats.count('media bytes copied', entry['size'])
+                    print('Moved file (%s): ' % method, data_file)
+
+    def source_status(self, table, name, directory):
+        """ Stat first, hash to confirm. Returns 'unchanged', 'touched' (the
+        file was written to but its content is the same) or 'changed'.
+        """
+        entry = self.state.table(table)[name]
+        path = os.path.join(directory, name)
+        stat = self.snapshot.stat(path)
+        if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return 'unchanged'
+
+        if 'digest' in entry:
+            self.stats.count('files hashed')
+            unchanged = entry['digest'] == file_digest(path)
+        else:
+            # Entries stored before digests were, only have an int mtime
+            unchanged = int(stat.st_mtime) <= entry.get('mod', -1)
+
+        if not unchanged:
+            return 'changed'
+
+        entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        entry.pop('mod', None)
+        if 'digest' not in entry:
+            entry['digest'] = file_digest(path)
+        self.state.set(table, name, entry)
+        self.touched[table].append(name)
+        print('Touched but unchanged:', name)
+        return 'touched'
+
+    def read_source(self, path, previous, kind):
+        """ Sources that haven't changed since their body was cached (same
+        size and mtime, rendered with the current settings) only have their
+        header read; the rest are read whole, to be hashed.
+        """
+        stat = self.snapshot.stat(path)
+        if previous and previous.get('body') and previous.get('digest') \
+                and previous.get('size') == stat.st_size \
+                and previous.get('mtime_ns') == stat.st_mtime_ns \
+                and self.state.table('templates').get(kind + ' settings') == self.body_cache.salt_id:
+            source = SourceFile(path, body_key=previous['body'], digest=previous['digest'])
+        else:
+            source = SourceFile(path, whole=True)
+            source.body_key = self.body_cache.key(source.body)
+        self.stats.count('bytes read', source.bytes_read)
+        return (source, stat)
 
-    def add_page(self, page, new=False):
-        mod_time = os.path.getmtime(os.path.join(self.pages_path, page))
+    def add_post(self, post, new=False, render=True):
         try:
-            with open(os.path.join(self.pages_path, page), 'r') as source:
-                txt = source.read()
-                try:
-                    (meta, body) = re.split('\n{2,}', txt, 1)
-                    (title, meta) = re.split('={3,}', meta, 1)
-                except ValueError as error:
-                    print(error)
-                else:
-                    if yaml.load(meta):
-                        meta = yaml.load(meta)
-                    else:
-                        meta = {}
-                    meta = self.get_page_meta(meta, title)
+            (source, stat) = self.read_source(os.path.join(self.posts_path, post),
+                                              None if new else self.posts[post], 'posts')
+        except (IOError, ValueError) as error:
+            print(error)
+            return None
+        meta = self.set_post_meta(source.meta, source.title, post, new)
+
+        if not new:
+            previous = self.posts[post]
+            if previous['slug'] != meta['slug'] \
+                    or previous['published'] != meta['date'] \
+                    or previous['draft'] != meta['draft']:
+                # The post is moving, its old outputs have to go
+                self.remove_post(post)
+            if previous.get('body') != source.body_key:
+                self.body_cache.evict(previous.get('body', ''))
 
-                    if not new:
-                        if self.pages[page]['slug'] != meta['slug']:
-                            page_path = self.is_page_rendered(page)
-                            if page_path:
-                                new_path = os.path.join(self.webroot, meta['slug'])
-                                os.rename(page_path, new_path)
+        self.state.set('posts', post,
+                       self.post_entry(meta, source, stat, None if new else self.posts[post]))
+        self.index.update(post, self.posts[post])
 
-                    self.pages[page] = {
-                        'mod': int(mod_time),
-                        'title': meta['title'],
-                        'slug': meta['slug']
-                    }
+        if not render:
+            return (post, meta, source)
+        self.set_neighbors(post, meta)
+        self.render_post(meta, source, 'posts/' + post)
+        self.index_post(post, meta, source)
 
-                    self.render_page(meta, body)
+        print('Rendered:', post)
 
-                    print('Rendered page:', page)
-        except IOError as error:
+    def add_page(self, page, new=False, render=True):
+        try:
+            (source, stat) = self.read_source(os.path.join(self.pages_path, page),
+                                              None if new else self.pages[page], 'pages')
+        except (IOError, ValueError) as error:
             print(error)
+            return None
+        meta = self.get_page_meta(source.meta, source.title)
 
-    def add_file(self, data_file):
-        mod_time = os.path.getmtime(os.path.join(self.media_path, data_file))
+        if not new:
+            if self.pages[page]['slug'] != meta['slug']:
+                self.remove_page(page)
+            if self.pages[page].get('body') != source.body_key:
+                self.body_cache.evict(self.pages[page].get('body', ''))
+
+        self.state.set('pages', page,
+                       self.page_entry(meta, source, stat, None if new else self.pages[page]))
+
+        if not render:
+            return (page, meta, source)
+        self.render_page(meta, source, 'pages/' + page)
+
+        print('Rendered page:', page)
+
+    def post_entry(self, meta, source, stat, previous):
+        """ What the state keeps about a post """
+        return {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': source.digest,
+            'published': meta['date'],
+            'title': meta['title'],
+            'slug': meta['slug'],
+            'link': meta['link'],
+            'draft': meta['draft'],
+            'tags': meta['tags'],
+            'lastmod': self.lastmod(previous, source.digest, stat),
+            'body': source.body_key
+        }
+
+    def page_entry(self, meta, source, stat, previous):
+        return {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': source.digest,
+            'title': meta['title'],
+            'slug': meta['slug'],
+            'lastmod': self.lastmod(previous, source.digest, stat),
+            'body': source.body_key
+        }
+
+    def copy_file(self, data_file):
         src = os.path.join(self.media_path, data_file)
-        if os.path.isfile(src):
-            if not os.path.isdir(os.path.join(self.webroot, 'media/')):
-                os.makedirs(os.path.join(self.webroot, 'media/'))
+        try:
+            stat = os.stat(src)
+            digest = file_digest(src)
             dst = os.path.join(self.webroot, 'media/', data_file)
-            copyfile(src, dst)
-            self.media[data_file] = {
-                'mod': int(mod_time)
-            }
-            print('Moved file: ', data_file)
+            method = sync_file(src, dst, digest, self.media_sync)
+        except OSError as error:
+            print(error)
+            return (data_file, None, None)
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': digest
+        }
+        return (data_file, entry, method)
 
-    def remove_post(self, post):
-        post_path = self.is_post_rendered(post)
-        if post_path:
-            post_index = os.path.join(post_path, 'index.html')
+    def add_file(self, data_file):
+        self.sync_media([data_file])
+
+    def output_key(self, path):
+        """ Outputs are recorded relative to the webroot, except for drafts
+        previewed outside of it
+        """
+        path = os.path.abspath(path)
+        webroot = os.path.abspath(self.webroot)
+        if path.startswith(webroot + os.sep):
+            return os.path.relpath(path, webroot)
+        return path
+
+    def sources_index(self):
+        if self.output_sources is None:
+            self.output_sources = {}
+            for key, entry in self.manifest.items():
+                self.output_sources.setdefault(entry['source'], set()).add(key)
+        return self.output_sources
+
+    def record_output(self, key, digest, size, source):
+        previous = self.manifest.get(key)
+        if previous and previous['source'] != source:
+            self.sources_index().get(previous['source'], set()).discard(key)
+        self.state.set('manifest', key, {'digest': digest, 'size': size, 'source': source})
+        self.sources_index().setdefault(source, set()).add(key)
+
+    @timed('write outputs')
+    def write_output(self, path, content, source):
+        """ Every rendered file goes through here. Content identical to what the
+        manifest says is already there is not written again, so mtimes only
+        change when the file does, and new content is written to a temp file
+        and renamed into place, so readers never see a partial file.
+        """
+        if self.capture is not None:
+            self.capture[path] = content
+            return True
+        data = content.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        if self.output_unchanged(path, digest, source):
+            return False
+
+        atomic_write(path, data)
+        return self.wrote_output(path, digest, len(data), source)
+
+    @timed('write outputs')
+    def write_stream(self, path, chunks, source):
+        """ write_output for content generated a piece at a time, like a
+        template's generate(): the pieces go to the temp file as they come, so
+        the whole output is never held in memory. If it turns out to be
+        identical to what's in place, the temp file is dropped instead.
+        """
+        if self.capture is not None:
+            return self.write_output(path, ''.join(chunks), source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = temp_path(path)
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as output:
+                for chunk in chunks:
+                    data = chunk.encode('utf-8')
+                    sha1.update(data)
+                    size += len(data)
+                    output.write(data)
+            if self.output_unchanged(path, sha1.hexdigest(), source):
+                return False
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        return self.wrote_output(path, sha1.hexdigest(), size, source)
+
+    def output_unchanged(self, path, digest, source):
+        entry = self.manifest.get(self.output_key(path))
+        if entry and entry['digest'] == digest and entry['source'] == source \
+                and not self.rebuilding and os.path.isfile(path):
+            self.stats.count('outputs unchanged')
+            return True
+        return False
+
+    def wrote_output(self, path, digest, size, source):
+        self.snapshot.forget(path)
+        self.record_output(self.output_key(path), digest, size, source)
+        self.stats.count('outputs written')
+        self.stats.count('bytes written', size)
+        return True
+
+    def remove_outputs(self, source):
+        """ Removes everything the manifest says was written for a source.
+        Returns False when there was nothing recorded for it.
+        """
+        keys = self.sources_index().pop(source, set())
+        for key in keys:
+            self.remove_output_file(os.path.join(self.webroot, key))
+            self.state.delete('manifest', key)
+        return bool(keys)
+
+    def remove_output_file(self, path):
+        for remove_path in [path] + [path + ext for ext in ('.gz', '.br')]:
+            try:
+                os.remove(remove_path)
+            except OSError as error:
+                if os.path.exists(remove_path):
+                    print(error)
+        self.prune_dirs(os.path.dirname(path))
+        self.snapshot.forget(path)
+
+    @timed('compress outputs')
+    def compress_outputs(self):
+        """ Generates compressed sidecars for the outputs whose content changed
+        since their sidecars were last generated, on a thread pool (zlib and
+        brotli release the GIL while compressing).
+        """
+        to_compress = [key for (key, entry) in self.manifest.items()
+                       if entry.get('compressed') != entry['digest']
+                       and not os.path.isabs(key)
+                       and os.path.splitext(key)[-1].lower() in COMPRESSIBLE]
+        if not to_compress:
+            return
+
+        def compress(key):
+            try:
+                compress_file(os.path.join(self.webroot, key))
+            except OSError as error:
+                print(error)
+                return None
+            return key
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.media_workers) as pool:
+            compressed = [key for key in pool.map(compress, to_compress) if key]
+        for key in compressed:
+            self.state.set('manifest', key, dict(self.manifest[key],
+                                                 compressed=self.manifest[key]['digest']))
+        print('Compressed %d output(s)' % len(compressed))
+
+    def prune_dirs(self, directory):
+        """ Removes the directories an output removal left empty, stopping at
+        the webroot or the drafts directory
+        """
+        roots = [os.path.normpath(self.webroot), os.path.normpath(self.drafts_output)]
+        directory = os.path.normpath(directory)
+        while directory not in roots \
+                and any(directory.startswith(root + os.sep) for root in roots):
             try:
-                os.remove(post_index)
-                os.rmdir(post_path)
-                month_path = os.path.dirname(post_path)
                 # This is one of those times, when I hate macOS
-                if not len([name for name in os.listdir(month_path) \
-                            if name != ".DS_Store"]):
-                    if os.path.isfile(os.path.join(month_path, '.DS_Store')):
-                        os.remove(os.path.join(month_path, '.DS_Store'))
-                    os.rmdir(month_path)
-                    year_path = os.path.dirname(month_path)
-                    if not len([name for name in os.listdir(year_path) \
-                                if name != ".DS_Store"]):
-                        if os.path.isfile(os.path.join(year_path, '.DS_Store')):
-                            os.remove(os.path.join(year_path, '.DS_Store'))
-                        os.rmdir(year_path)
+                if [name for name in os.listdir(directory) if name != '.DS_Store']:
+                    return
+                if os.path.isfile(os.path.join(directory, '.DS_Store')):
+                    os.remove(os.path.join(directory, '.DS_Store'))
+                os.rmdir(directory)
             except OSError as error:
                 print(error)
+                return
+            directory = os.path.dirname(directory)
+
+    def clean_orphans(self):
+        """ Removes outputs whose source croissant no longer knows about """
+        tables = {'posts': self.posts, 'pages': self.pages, 'media': self.media}
+        for source in list(self.sources_index()):
+            (kind, _, name) = source.partition('/')
+            if kind in tables:
+                orphan = name not in tables[kind]
+            else:
+                orphan = source not in self.state.table('outputs')
+            if orphan:
+                print('Removing orphaned output of', source)
+                self.remove_outputs(source)
+
+    def remove_post(self, post):
+        if not self.remove_outputs('posts/' + post):
+            # Rendered before croissant kept a manifest
+            post_path = self.is_post_rendered(post)
+            if post_path:
+                self.remove_output_file(os.path.join(post_path, 'index.html'))
+            self.remove_draft(post)
 
     def remove_draft(self, post):
         post_path = os.path.join(self.drafts_output, self.posts[post]['slug'])
-        if os.path.isdir(post_path):
-            post_index = os.path.join(post_path, 'index.html')
-            try:
-                os.remove(post_index)
-                os.rmdir(post_path)
-            except OSError as error:
-                print(error)
+        if self.snapshot.isdir(post_path):
+            self.remove_output_file(os.path.join(post_path, 'index.html'))
 
     def remove_page(self, page):
-        page_path = self.is_page_rendered(page)
-        if page_path:
-            page_index = os.path.join(page_path, 'index.html')
-            try:
-                os.remove(page_index)
-                os.rmdir(page_path)
-            except OSError as error:
-                print(error)
+        if not self.remove_outputs('pages/' + page):
+            page_path = self.is_page_rendered(page)
+            if page_path:
+                self.remove_output_file(os.path.join(page_path, 'index.html'))
 
     def remove_file(self, data_file):
-        file_path = self.is_file_moved(data_file)
-        if file_path:
-            try:
-                os.remove(file_path)
-            except OSError as error:
-                print(error)
+        if not self.remove_outputs('media/' + data_file):
+            file_path = self.is_file_moved(data_file)
+            if file_path:
+                self.remove_output_file(file_path)
 
     def set_post_meta(self, meta, title, post, new):
         meta['title'] = title.strip()
@@ -400,17 +1920,62 @@ class Croissant:
             meta['slug'] = slugify(title)
         if 'draft' not in meta:
             meta['draft'] = False
+        # Either a list or a comma separated string
+        tags = meta.get('tags') or []
+        if not isinstance(tags, list):
+            tags = str(tags).split(',')
+        meta['tags'] = [str(tag).strip() for tag in tags if str(tag).strip()]
         return meta
 
+    def lastmod(self, previous, digest, stat):
+        """ When the content of a source last changed, for the sitemap. Kept
+        as it was when a post or page is rendered again without changing.
+        """
+        if previous and previous.get('digest') == digest and 'lastmod' in previous:
+            return previous['lastmod']
+        return datetime.fromtimestamp(stat.st_mtime_ns // 1000000000)
+
     def get_page_meta(self, meta, title):
         meta['title'] = title.strip()
         if 'slug' not in meta:
             meta['slug'] = slugify(title)
         return meta
 
-    def render_post(self, meta, body):
-        html_body = markdown.markdown(body, output_format='html5')
-        html_body = self.rewrite_links(html_body)
+    @timed('render body')
+    def render_body(self, source):
+        """ Renders the body of a SourceFile, which is only read on a cache miss """
+        key = source.body_key or self.body_cache.key(source.body)
+        html_body = self.body_cache.get(key)
+        if html_body is None:
+            with self.stats.timer('markdown'):
+                html_body = self.renderer.render(source.body)
+            html_body = self.rewrite_links(html_body)
+            self.body_cache.put(key, html_body)
+        return html_body
+
+    def get_post_body(self, post):
+        """ Returns the rendered body of an already added post, from the body
+        cache when possible, so the homepage and RSS passes don't have to run
+        markdown again for posts that add_post just rendered.
+        """
+        key = self.posts[post].get('body')
+        if key:
+            html_body = self.body_cache.get(key)
+            if html_body is not None:
+                return html_body
+
+        source = SourceFile(os.path.join(self.posts_path, post))
+        source.body_key = self.body_cache.key(source.body)
+        if key != source.body_key:
+            entry = dict(self.posts[post], body=source.body_key)
+            self.state.set('posts', post, entry)
+        return self.render_body(source)
+
+    @timed('render post')
+    def build_post(self, meta, source_file):
+        """ Renders a post, returning its output path and HTML """
+        html_body = self.render_body(source_file)
+        neighbors = meta.pop('neighbors', None) or {}
 
         if not meta['draft']:
             post_path = '%s/%s/%s' % (
@@ -422,148 +1987,435 @@ class Croissant:
             post_path = os.path.join(self.drafts_output, meta['slug'])
 
         template = self.env.get_template('post.html')
-        if not os.path.isdir(os.path.join(self.webroot, post_path)):
-            os.makedirs(os.path.join(self.webroot, post_path))
-        post_html = open(os.path.join(self.webroot, post_path, 'index.html'), 'w')
-        post_html.write(template.render(meta=meta, body=html_body))
-        post_html.close()
+        return (os.path.join(self.webroot, post_path, 'index.html'),
+                template.render(meta=meta, body=html_body, previous=neighbors.get('previous'),
+                                next=neighbors.get('next')))
+
+    def render_post(self, meta, source_file, source):
+        (path, html) = self.build_post(meta, source_file)
+        self.write_output(path, html, source)
 
-    def render_page(self, meta, body):
-        html_body = markdown.markdown(body, output_format='html5')
-        html_body = self.rewrite_links(html_body)
+    @timed('render page')
+    def build_page(self, meta, source_file):
+        html_body = self.render_body(source_file)
 
         page_path = meta['slug']
 
         template = self.env.get_template('page.html')
-        if not os.path.isdir(os.path.join(self.webroot, page_path)):
-            os.makedirs(os.path.join(self.webroot, page_path))
-        page_html = open(os.path.join(self.webroot, page_path, 'index.html'), 'w')
-        page_html.write(template.render(meta=meta, body=html_body))
-        page_html.close()
-
-    def render_homepage(self):
-        # Getting non-draft posts
-        published_posts = dict(post for post in self.posts.items() if not post[1]['draft'])
-        # Ordering posts by publish date
-        ordered_posts = OrderedDict(sorted(published_posts.items(),
-                                           key=lambda t: t[1]['published'], reverse=True))
-        # Keeping specified newest posts
-        newest_posts = list(ordered_posts)[:self.posts_in_homepage]
-
-        homepage_posts = {}
-        for post in newest_posts:
-            title = self.posts[post]['title']
+        return (os.path.join(self.webroot, page_path, 'index.html'),
+                template.render(meta=meta, body=html_body))
+
+    def render_page(self, meta, source_file, source):
+        (path, html) = self.build_page(meta, source_file)
+        self.write_output(path, html, source)
+
+    def newest_posts(self, count=None):
+        """ Names of the published (non-draft) posts, newest first """
+        return self.index.newest(count)
+
+    def archive_partitions(self):
+        """ Published posts grouped by year, or by month, newest first """
+        partitions = OrderedDict()
+        for post in self.newest_posts():
             date = self.posts[post]['published']
-            with open(os.path.join(self.posts_path, post), 'r') as source:
-                txt = source.read()
-                try:
-                    (_, body) = re.split('\n{2,}', txt, 1)
-                except ValueError as error:
-                    print(error)
+            if self.archive_by_month:
+                partition = '%s/%s' % (date.year, '{:02d}'.format(date.month))
+            else:
+                partition = str(date.year)
+            partitions.setdefault(partition, []).append(post)
+        return partitions
+
+    def homepage_path(self, number):
+        if number == 1:
+            return os.path.join(self.webroot, 'index.html')
+        return os.path.join(self.webroot, 'page/', str(number), 'index.html')
+
+    def homepage_uri(self, number):
+        if number == 1:
+            return '/'
+        return '/page/%d/' % number
+
+    def post_inputs(self, posts, fields):
+        """ Short digests of the fields of each post an output is built from """
+        inputs = {}
+        for post in posts:
+            entry = self.posts[post]
+            inputs[post] = [hashlib.sha1(str(entry.get(field)).encode('utf-8')).hexdigest()[:8]
+                            for field in fields]
+        return inputs
+
+    def rebuild_reasons(self, output, inputs, fields, path):
+        """ Compares the inputs of an aggregate output with the ones it was
+        last built from, and explains what changed. An empty list means the
+        output is up to date.
+        """
+        previous = self.state.table('outputs').get(output)
+        if not os.path.isfile(path):
+            return ['output missing']
+        if previous is None:
+            return ['no record of previous build']
+
+        reasons = []
+        for name in inputs:
+            if name not in previous:
+                reasons.append('added %s' % name)
+            elif previous[name] != inputs[name]:
+                if len(inputs[name]) == len(fields) and not name.startswith('#'):
+                    changed = [field for (field, old, new)
+                               in zip(fields, previous[name], inputs[name]) if old != new]
+                    reasons.append('changed %s (%s)' % (name, ', '.join(changed)))
                 else:
-                    html_body = markdown.markdown(body, output_format='html5')
-                    html_body = self.rewrite_links(html_body)
-            uri = '/%s/%s/%s' % (
-                date.year,
-                str('{:02d}'.format(date.month)),
-                self.posts[post]['slug']
-            )
-            link = self.posts[post]['link']
-            homepage_posts[post] = {
-                'title': title,
-                'date': date,
-                'body': html_body,
-                'uri': uri,
-                'link': link
-            }
-        
-        # Reordering posts
-        ordered_posts = OrderedDict(sorted(homepage_posts.items(),
-                                           key=lambda t: t[1]['date'], reverse=True))
+                    reasons.append('changed %s' % name)
+        for name in previous:
+            if name not in inputs:
+                reasons.append('removed %s' % name)
+        return reasons
+
+    def render_if_needed(self, output, inputs, fields, path, render, template):
+        if template:
+            inputs['#template %s' % template] = [self.template_digest(template)]
+        reasons = self.rebuild_reasons(output, inputs, fields, path)
+        if reasons:
+            if len(reasons) > 5:
+                reasons = reasons[:5] + ['and %d more' % (len(reasons) - 5)]
+            print('Rebuilding %s: %s' % (output, '; '.join(reasons)))
+            render()
+            self.state.set('outputs', output, inputs)
+
+    def drop_output(self, output, path):
+        """ Removes an aggregate output that no longer has any posts """
+        if not self.remove_outputs(output) and os.path.isfile(path):
+            self.remove_output_file(path)
+        self.state.delete('outputs', output)
+        print('Removed', output)
+
+    @timed('search index')
+    def index_post(self, post, meta, source_file):
+        """ Drafts are left out of the search index """
+        if meta['draft']:
+            self.search.remove(post)
+        else:
+            uri = '%d/%02d/%s/' % (meta['date'].year, meta['date'].month, meta['slug'])
+            self.search.add(post, meta['title'], uri, self.render_body(source_file))
+
+    @timed('search index')
+    def build_search_index(self, planned):
+        """ Indexes the published posts from their cached bodies when
+        cache/search.json is missing (a new install, or a cleared cache). The
+        planned posts are indexed when they're rendered.
+        """
+        print('Building the search index')
+        self.search.load()
+        # Written at the end of the update, even if all the posts are drafts
+        self.search.mark([], True)
+        for post in self.newest_posts():
+            if post in planned:
+                continue
+            entry = self.posts[post]
+            try:
+                body = self.get_post_body(post)
+            except (IOError, ValueError) as error:
+                print(error)
+                continue
+            self.search.add(post, entry['title'], self.post_uri(entry)[1:] + '/', body)
+
+    @timed('search index')
+    def write_search_index(self):
+        directory = os.path.join(self.webroot, 'search/')
+        # Files lost with the webroot are written again. That's rare enough
+        # to simply write the whole index.
+        for output in self.state.table('outputs'):
+            if output == 'search' or output.startswith('search/'):
+                name = 'docs' if output == 'search' else output[len('search/'):]
+                if not self.snapshot.isfile(os.path.join(directory, name + '.json')):
+                    print('Search index file missing, writing it again')
+                    self.search.mark_all()
+                    break
+        (shards, docs) = self.search.pending()
+        if not shards and not docs:
+            return
+        for (name, terms) in sorted(self.search.shards(shards).items()):
+            output = 'search/' + name
+            path = os.path.join(directory, name + '.json')
+            if terms:
+                self.write_output(path, json.dumps(terms, sort_keys=True, ensure_ascii=False,
+                                                   separators=(',', ':')), output)
+                self.state.set('outputs', output, {'#terms': [str(len(terms))]})
+            elif output in self.state.table('outputs'):
+                self.drop_output(output, path)
+        if docs:
+            docs = self.search.docs()
+            self.write_output(os.path.join(directory, 'docs.json'),
+                              json.dumps(docs, ensure_ascii=False, separators=(',', ':')),
+                              'search')
+            self.state.set('outputs', 'search', {'#posts': [str(len(docs))]})
+        self.search.written()
+
+        size = sum(entry['size'] for (key, entry) in self.manifest.items()
+                   if key.startswith('search' + os.sep))
+        self.stats.count('search shards written', len(shards))
+        self.stats.count('search index bytes', size)
+        print('Updated the search index (%d shard(s), %d bytes in total)' % (len(shards), size))
+
+    def render_aggregates(self):
+        """ Rebuilds the homepage pages, RSS feed and archive partitions, each
+        one only when the posts and post fields it's actually built from have
+        changed.
+        """
+        outputs = set()
+        for (output, inputs, fields, render, template) in self.aggregates():
+            outputs.add(output)
+            self.render_if_needed(output, inputs, fields, self.aggregate_path(output),
+                                  render, template)
+
+        # Homepage pages, archive partitions, feeds and sitemap shards that ran out of posts
+        for output in list(self.state.table('outputs')):
+            if output.startswith(('homepage/', 'archive/', 'feeds/', 'sitemap/')) \
+                    and output not in outputs:
+                self.drop_output(output, self.aggregate_path(output))
+
+    def aggregates(self):
+        """ Every output built from a list of posts, as (output, inputs, fields,
+        render, template): the inputs are digests of the fields of the posts it
+        lists, and render writes it.
+        """
+        feed_fields = ('title', 'published', 'slug', 'link', 'body')
+        archive_fields = ('title', 'published', 'slug')
+
+        newest = self.newest_posts(self.posts_in_homepage * self.homepage_pages)
+        pages = [newest[start:start + self.posts_in_homepage]
+                 for start in range(0, len(newest), self.posts_in_homepage)] or [[]]
+        for number, posts in enumerate(pages, 1):
+            inputs = self.post_inputs(posts, feed_fields)
+            inputs['#older-page'] = [str(number < len(pages))]
+            yield ('homepage' if number == 1 else 'homepage/%d' % number, inputs, feed_fields,
+                   lambda number=number, posts=posts: self.render_homepage(number, posts, len(pages)),
+                   'home.html')
+
+        yield ('rss', self.post_inputs(self.newest_posts(self.rss_posts), feed_fields),
+               feed_fields, self.render_rss, 'rss.xml')
+
+        partitions = self.archive_partitions()
+        for partition, posts in partitions.items():
+            yield ('archive/' + partition, self.post_inputs(posts, archive_fields), archive_fields,
+                   lambda partition=partition, posts=posts: self.render_archive(partition, posts),
+                   'archive.html')
+        yield ('archive',
+               dict((partition, [str(len(posts))]) for partition, posts in partitions.items()),
+               ('posts',), lambda: self.render_archive_index(partitions), 'archive.html')
+
+        for feed, posts in self.feed_partitions().items():
+            yield (feed, self.post_inputs(posts, feed_fields), feed_fields,
+                   lambda feed=feed, posts=posts: self.render_feed(feed, posts), 'rss.xml')
+
+        shards = self.sitemap_shards()
+        for number, urls in enumerate(shards, 1):
+            output = 'sitemap' if len(shards) == 1 else 'sitemap/%d' % number
+            # One digest per shard, which can hold up to 50,000 URLs
+            inputs = {'#urls': [hashlib.sha1('\n'.join(
+                '%s|%s' % (url, lastmod) for (url, lastmod) in urls).encode('utf-8')).hexdigest()]}
+            yield (output, inputs, ('urls',),
+                   lambda output=output, urls=urls: self.render_sitemap(output, urls), None)
+        if len(shards) > 1:
+            yield ('sitemap', {'#shards': [str(len(shards))]}, ('shards',),
+                   lambda: self.render_sitemap_index(len(shards)), None)
+
+    def aggregate_path(self, output):
+        """ Where an aggregate output is written, by name """
+        if output == 'homepage':
+            return self.homepage_path(1)
+        if output.startswith('homepage/'):
+            return self.homepage_path(int(output.split('/')[1]))
+        if output == 'rss' or output.startswith('feeds/'):
+            return os.path.join(self.webroot, output + '.xml')
+        if output == 'sitemap' or output.startswith('sitemap/'):
+            return self.sitemap_path(output)
+        return os.path.join(self.webroot, output, 'index.html')
+
+    def feed_partitions(self):
+        """ The newest posts of every year and tag with a feed of its own, by
+        output name (feeds/2017, feeds/tags/python...)
+        """
+        feeds = OrderedDict()
+        for post in self.newest_posts():
+            entry = self.posts[post]
+            names = []
+            if 'year' in self.feeds:
+                names.append('feeds/%d' % entry['published'].year)
+            if 'tag' in self.feeds:
+                names.extend('feeds/tags/%s' % slugify(tag) for tag in entry.get('tags', [])
+                             if slugify(tag))
+            for name in names:
+                posts = feeds.setdefault(name, [])
+                if len(posts) < self.rss_posts and post not in posts:
+                    posts.append(post)
+        return feeds
+
+    def sitemap_shards(self):
+        """ (url, lastmod) of the homepage, pages and published posts, oldest
+        posts first so new ones only change the last shard
+        """
+        urls = [(self.blog_url, None)]
+        for page in sorted(self.pages):
+            urls.append((self.blog_url + self.pages[page]['slug'] + '/',
+                         self.pages[page].get('lastmod')))
+        for post in reversed(self.newest_posts()):
+            entry = self.posts[post]
+            urls.append((self.post_url(entry) + '/', entry.get('lastmod', entry['published'])))
+        return [urls[start:start + SITEMAP_URLS] for start in range(0, len(urls), SITEMAP_URLS)]
+
+    def sitemap_path(self, output):
+        if output == 'sitemap':
+            return os.path.join(self.webroot, 'sitemap.xml')
+        return os.path.join(self.webroot, 'sitemap-%s.xml' % output.split('/')[1])
+
+    def post_url(self, entry):
+        return self.blog_url + self.post_uri(entry)[1:]
+
+    def post_uri(self, entry):
+        date = entry['published']
+        return '/%s/%s/%s' % (date.year, '{:02d}'.format(date.month), entry['slug'])
+
+    def post_link(self, post):
+        if post is None:
+            return None
+        return {'title': self.posts[post]['title'], 'uri': self.post_uri(self.posts[post])}
+
+    def post_neighbors(self, post):
+        """ Links to the published posts before and after a post, as post.html
+        gets them: previous is the older one, next the newer one
+        """
+        entry = self.posts[post]
+        if entry['draft']:
+            return {'previous': None, 'next': None}
+        (older, newer) = self.index.neighbors(post, entry['published'])
+        return {'previous': self.post_link(older), 'next': self.post_link(newer)}
+
+    def neighbors_digest(self, neighbors):
+        return hashlib.sha1(json.dumps(neighbors, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+    def set_neighbors(self, post, meta):
+        """ Hands a post about to be rendered its neighbors, and records which
+        ones it was rendered with
+        """
+        meta['neighbors'] = self.post_neighbors(post)
+        self.state.set('posts', post, dict(self.posts[post],
+                                           neighbors=self.neighbors_digest(meta['neighbors'])))
+
+    def neighbor_jobs(self, planned):
+        """ Jobs for the published posts whose previous or next post is not the
+        one they were rendered with, or has a new title or URL: the ones next
+        to a post that was added, removed, re-dated, drafted or renamed.
+        """
+        entries = self.index.entries
+        links = [self.post_link(post) for (_, post) in entries]
+        changed = []
+        for position, (_, post) in enumerate(entries):
+            if post in planned:
+                continue
+            neighbors = {'previous': links[position - 1] if position > 0 else None,
+                         'next': links[position + 1] if position + 1 < len(links) else None}
+            if self.posts[post].get('neighbors') != self.neighbors_digest(neighbors):
+                changed.append(post)
+        if changed:
+            print('Neighbors changed, re-rendering %d post(s)' % len(changed))
+        return [job for job in (self.add_post(post, render=False) for post in changed) if job]
+
+    @timed('render homepage')
+    def render_homepage(self, number=1, newest_posts=None, page_count=1):
+        if newest_posts is None:
+            newest_posts = self.newest_posts(self.posts_in_homepage)
+
+        pagination = {
+            'newer': self.homepage_uri(number - 1) if number > 1 else None,
+            'older': self.homepage_uri(number + 1) if number < page_count else None
+        }
 
         template = self.env.get_template('home.html')
-        home_html = open(os.path.join(self.webroot, 'index.html'), 'w')
-        home_html.write(template.render(posts=ordered_posts.items()))
-        home_html.close()
-        print('Rendered homepage')
-
-    def render_archive(self):
-        # Getting non-draft posts
-        published_posts = list(dict(post for post in self.posts.items() if not post[1]['draft']))
-
-        archive_posts = {}
-        for post in published_posts:
-            title = self.posts[post]['title']
-            date = self.posts[post]['published']
-            uri = '/%s/%s/%s' % (
-                date.year,
-                str('{:02d}'.format(date.month)),
-                self.posts[post]['slug']
-            )
-            archive_posts[post] = {
-                'title': title,
-                'date': date,
-                'uri': uri,
-            }
-
-        ordered_posts = OrderedDict(sorted(archive_posts.items(),
-                                           key=lambda t: t[1]['date'], reverse=True))
+        self.write_stream(self.homepage_path(number),
+                          template.generate(posts=self.lazy_posts(newest_posts),
+                                            pagination=pagination),
+                          'homepage' if number == 1 else 'homepage/%d' % number)
+        if number == 1:
+            print('Rendered homepage')
+        else:
+            print('Rendered homepage page', number)
 
+    @timed('render archive')
+    def render_archive(self, partition, posts):
         template = self.env.get_template('archive.html')
-        if not os.path.isdir(os.path.join(self.webroot, 'archive/')):
-            os.makedirs(os.path.join(self.webroot, 'archive/'))
-        archive_html = open(os.path.join(self.webroot, 'archive/', 'index.html'), 'w')
-        archive_html.write(template.render(posts=ordered_posts.items()))
-        archive_html.close()
+        self.write_stream(os.path.join(self.webroot, 'archive/', partition, 'index.html'),
+                          template.generate(posts=self.lazy_posts(posts), partition=partition),
+                          'archive/' + partition)
+        print('Rendered archive page for', partition)
+
+    @timed('render archive index')
+    def render_archive_index(self, partitions):
+        archive_partitions = [{
+            'name': partition,
+            'uri': '/archive/%s/' % partition,
+            'count': len(posts)
+        } for partition, posts in partitions.items()]
+
+        template = self.env.get_template('archive.html')
+        self.write_output(os.path.join(self.webroot, 'archive/', 'index.html'),
+                          template.render(posts=[], partitions=archive_partitions),
+                          'archive')
         print('Rendered archive page')
 
-    def render_rss(self):
-        # Getting non-draft posts
-        published_posts = dict(post for post in self.posts.items() if not post[1]['draft'])
-        # Ordering posts by publish date
-        ordered_posts = OrderedDict(sorted(published_posts.items(),
-                                           key=lambda t: t[1]['published'], reverse=True))
-        # Keeping specified newest posts
-        newest_posts = list(ordered_posts)[:self.rss_posts]
-
-        rss_posts = {}
-        for post in newest_posts:
-            title = self.posts[post]['title']
-            date = self.posts[post]['published']
-            with open(os.path.join(self.posts_path, post), 'r') as source:
-                txt = source.read()
-                try:
-                    (_, body) = re.split('\n{2,}', txt, 1)
-                except ValueError as error:
-                    print(error)
-                else:
-                    html_body = markdown.markdown(body, output_format='html5')
-                    html_body = self.rewrite_links(html_body)
-            url = '%s%s/%s/%s' % (
-                self.blog_url,
-                date.year,
-                str('{:02d}'.format(date.month)),
-                self.posts[post]['slug']
-            )
-            link = self.posts[post]['link']
-            rss_posts[post] = {
-                'title': title,
-                'date': date,
-                'body': html_body,
-                'url': url,
-                'link': link
-            }
-
-        # Reordering posts
-        ordered_posts = OrderedDict(sorted(rss_posts.items(),
-                                           key=lambda t: t[1]['date'], reverse=True))
+    def lazy_posts(self, posts):
+        """ (post, LazyPost) pairs for the aggregate templates, made as the
+        template iterates over them
+        """
+        return ((post, LazyPost(self, post)) for post in posts)
 
+    @timed('render rss')
+    def render_rss(self):
         template = self.env.get_template('rss.xml')
-        rss_html = open(os.path.join(self.webroot, 'rss.xml'), 'w')
-        rss_html.write(template.render(posts=ordered_posts.items()))
-        rss_html.close()
+        self.write_stream(os.path.join(self.webroot, 'rss.xml'),
+                          template.generate(posts=self.lazy_posts(self.newest_posts(self.rss_posts))),
+                          'rss')
         print('Rendered RSS feed')
 
+    @timed('render feeds')
+    def render_feed(self, feed, posts):
+        """ A feed of the posts of one year or tag, with the RSS template """
+        if feed.startswith('feeds/tags/'):
+            # The tag as written in the newest post
+            name = next(tag for tag in self.posts[posts[0]].get('tags', [])
+                        if slugify(tag) == feed[len('feeds/tags/'):])
+        else:
+            name = feed[len('feeds/'):]
+        template = self.env.get_template('rss.xml')
+        self.write_stream(os.path.join(self.webroot, feed + '.xml'),
+                          template.generate(posts=self.lazy_posts(posts), feed=name), feed)
+        print('Rendered feed for', name)
+
+    @timed('render sitemap')
+    def render_sitemap(self, output, urls):
+        from xml.sax.saxutils import escape
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+        for (url, lastmod) in urls:
+            if lastmod:
+                lines.append('<url><loc>%s</loc><lastmod>%s</lastmod></url>' % (
+                    escape(url), lastmod.strftime('%Y-%m-%d')))
+            else:
+                lines.append('<url><loc>%s</loc></url>' % escape(url))
+        lines.append('</urlset>')
+        self.write_output(self.sitemap_path(output), '\n'.join(lines) + '\n', output)
+        print('Rendered %s (%d URLs)' % (os.path.basename(self.sitemap_path(output)), len(urls)))
+
+    @timed('render sitemap')
+    def render_sitemap_index(self, count):
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+        for number in range(1, count + 1):
+            lines.append('<sitemap><loc>%ssitemap-%d.xml</loc></sitemap>' % (self.blog_url, number))
+        lines.append('</sitemapindex>')
+        self.write_output(self.sitemap_path('sitemap'), '\n'.join(lines) + '\n', 'sitemap')
+        print('Rendered sitemap index (%d sitemaps)' % count)
+
     def is_post_rendered(self, post):
         post_date = self.posts[post]['published']
         post_path = '%s/%s/%s' % (
@@ -572,49 +2424,530 @@ class Croissant:
             self.posts[post]['slug']
         )
 
-        if os.path.isdir(os.path.join(self.webroot, post_path)):
+        if self.snapshot.isdir(os.path.join(self.webroot, post_path)):
             return os.path.join(self.webroot, post_path)
         else:
             return False
 
     def is_page_rendered(self, page):
-        if os.path.isdir(os.path.join(self.webroot, self.pages[page]['slug'])):
+        if self.snapshot.isdir(os.path.join(self.webroot, self.pages[page]['slug'])):
             return os.path.join(self.webroot, self.pages[page]['slug'])
         else:
             return False
 
     def is_file_moved(self, data_file):
-        if os.path.isfile(os.path.join(self.webroot, 'media/', data_file)):
+        if self.snapshot.isfile(os.path.join(self.webroot, 'media/', data_file)):
             return os.path.join(self.webroot, 'media/', data_file)
         else:
             return False
 
+    @timed('rewrite links')
     def rewrite_links(self, text):
-        text = re.sub(
-            r" src=[\"']../media/([^/]+?)[\"']",
-            ' src="%s%s/%s"' % (self.blog_url, 'media', r"\1"),
-            text
-        )
-        text = re.sub(
-            r" href=[\"']../media/([^/]+?)[\"']",
-            ' href=%s/%s/%s' % (self.blog_url, 'media', r"\1"),
-            text
-        )
+        return MEDIA_LINKS.sub(
+            lambda link: ' %s="%smedia/%s"' % (link.group(1), self.blog_url, link.group(2)),
+            text)
+
+
+# Croissant instances kept by each worker process, least recently used first.
+# A pool shared by several sites only keeps the last few of them around.
+_worker_sites = OrderedDict()
+WORKER_SITES = 4
+
+
+def render_job(root, webroot, kind, meta, source):
+    """ Runs in a worker process of the rendering pool """
+    if root in _worker_sites:
+        _worker_sites.move_to_end(root)
+    else:
+        # Workers only render; the state belongs to the parent
+        _worker_sites[root] = Croissant(root, state=MemoryStateStore({}))
+        if len(_worker_sites) > WORKER_SITES:
+            _worker_sites.popitem(last=False)
+    site = _worker_sites[root]
+    # Which may be a staging webroot
+    site.use_webroot(webroot)
+    # Fresh stats for every job, handed back to be merged in the parent
+    site.stats = site.body_cache.stats = Stats()
+    if kind == 'post':
+        (path, html) = site.build_post(meta, source)
+    else:
+        (path, html) = site.build_page(meta, source)
+    return (path, html, site.stats.as_dict())
+
+
+@contextlib.contextmanager
+def site_lock(root):
+    """ Held while a site is being updated. The lock belongs to the site, so
+    different sites can be updated at the same time, and flock locks go away
+    with the process, so a crashed run never leaves one behind. Raises
+    BlockingIOError when the site is already being updated.
+    """
+    import fcntl
+    cache_path = os.path.join(root, 'cache')
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+    with open(os.path.join(cache_path, 'croissant.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        yield
+
+
+def last_update_seconds(root):
+    try:
+        with open(os.path.join(root, 'cache', 'snapshot.json'), 'r') as snapshot_file:
+            return json.load(snapshot_file).get('seconds', 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def run_sites(roots, workers=None, stats=False):
+    """ Updates several sites in one process, rendering them on a single
+    worker pool instead of starting one per site. Sites with nothing to do are
+    ruled out with the fast path first, and the rest are updated quickest
+    first (going by how long their last update took), so a big site doesn't
+    keep all the small ones waiting. A site that is locked by another run,
+    has no configuration or fails (exits included) is reported and skipped.
+    """
+    roots = [os.path.abspath(root) for root in roots]
+    timings = OrderedDict((root, ('unchanged', 0.0)) for root in roots)
+    pending = sorted((root for root in roots if not site_unchanged(root)),
+                     key=last_update_seconds)
+    pool = None
+    try:
+        for root in pending:
+            # Checked before locking, which would create cache/ in any directory
+            if not os.path.isfile(os.path.join(root, 'config', 'config.yaml')):
+                print('%s has no config/config.yaml, skipping' % root)
+                timings[root] = ('failed', 0.0)
+                continue
+            started = time.perf_counter()
+            try:
+                with site_lock(root):
+                    if pool is None:
+                        from concurrent.futures import ProcessPoolExecutor
+                        pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+                    print('Updating %s' % root)
+                    croissant = Croissant(root, pool)
+                    try:
+                        croissant.update()
+                    finally:
+                        croissant.close()
+                    if stats:
+                        print(croissant.stats.report())
+                status = 'updated'
+            except BlockingIOError:
+                print('%s is already being updated, skipping' % root)
+                status = 'locked'
+            except SystemExit as error:
+                # Raised by sys.exit() for a bad configuration or state
+                print('%s: %s' % (root, error))
+                status = 'failed'
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                status = 'failed'
+            timings[root] = (status, time.perf_counter() - started)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    width = max(len(root) for root in roots)
+    for (root, (status, seconds)) in timings.items():
+        print('%-*s  %-9s  %8.3fs' % (width, root, status, seconds))
+    return timings
+
+
+def report_stats(croissant, show, json_path):
+    if show:
+        print(croissant.stats.report())
+    if json_path:
+        stats = croissant.stats.as_dict()
+        if json_path == '-':
+            print(json.dumps(stats, indent=2))
+        else:
+            with open(json_path, 'w') as stats_file:
+                json.dump(stats, stats_file, indent=2)
+
+
+def watch(root, interval=1.0, debounce=2.0, stats=False, stats_json=None):
+    """ Keeps a Croissant instance resident and runs an update every time
+    something changes in the source, templates or config directories.
+    """
+    croissant = Croissant(root)
+    try:
+        croissant.update()
+        report_stats(croissant, stats, stats_json)
+        watcher = SourceWatcher(croissant.watched_paths(), interval, debounce,
+                                ignore=croissant.state_files())
+        while True:
+            changed = watcher.wait()
+            print('Changes detected in %d file(s)' % len(changed))
+            try:
+                if any(path.startswith(croissant.config_path) for path in changed):
+                    print('Reloading configuration')
+                    croissant.close()
+                    croissant = Croissant(root)
+                    watcher.paths = croissant.watched_paths()
+                    watcher.last = watcher.snapshot()
+                croissant.stats = croissant.body_cache.stats = Stats()
+                croissant.update()
+                report_stats(croissant, stats, stats_json)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        croissant.close()
+
+
+# Added to every HTML page the preview server sends, to reload it on changes
+PREVIEW_SCRIPT = ('<script>new EventSource("/_preview/events").onmessage = '
+                  'function () { location.reload(); };</script>')
+
+
+class Preview:
+    """ The site as it would be built from the sources right now, for the
+    preview server. Posts and pages are read into a copy of the state that is
+    never saved and outputs are rendered into memory, so nothing is written to
+    the webroot or the state. Rendered outputs are kept by URL with a digest
+    of what they were built from (the source, the templates, the fields of
+    the posts an aggregate lists), and only rendered again when it changes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        # Bumped after every change, for the pages open in a browser to reload
+        self.changed = threading.Condition()
+        self.generation = 0
+        self.load()
+
+    def load(self):
+        site = Croissant(self.root, state=MemoryStateStore({}))
+        if site.state_backend not in state_backends:
+            sys.exit('Unknown state backend: %s' % site.state_backend)
+        (filename, store_class) = state_backends[site.state_backend]
+        # A copy of what the site's state knows, read without writing to it
+        tables = store_class.read(os.path.join(site.config_path, filename))
+        for name in ('posts', 'pages', 'templates', 'template_sources'):
+            site.state.table(name).update(tables.get(name, {}))
+        site.index = PostIndex(site.state, site.posts)
+        site.capture = {}
+        self.site = site
+        # (size, mtime_ns, meta, source) of the posts and pages read, by path
+        self.sources = {}
+        # What every URL is rendered from, and what was rendered for it
+        self.routes = {}
+        self.rendered = {}
+        self.refresh()
+
+    def refresh(self):
+        """ Reads the posts and pages that changed since the last refresh and
+        works out the URLs of the site again
+        """
+        site = self.site
+        site.snapshot = FileSnapshot(site.stats)
+        site.template_digests = {}
+        for (kind, directory) in (('posts', site.posts_path), ('pages', site.pages_path)):
+            table = site.state.table(kind)
+            names = [name for name in site.snapshot.files(directory)
+                     if os.path.splitext(name)[-1].lower() in ('.md', '.markdown', '.txt')]
+            for name in list(table):
+                if name not in names:
+                    site.state.delete(kind, name)
+                    self.sources.pop(os.path.join(directory, name), None)
+                    if kind == 'posts':
+                        site.index.remove(name)
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stat = site.snapshot.stat(path)
+                    if self.sources.get(path, ())[:2] != (stat.st_size, stat.st_mtime_ns):
+                        self.read(kind, name, path)
+                except (IOError, ValueError) as error:
+                    # Most likely saved halfway, the last version read stays
+                    print(error)
+
+        routes = {}
+        for post in site.posts:
+            entry = site.posts[post]
+            if entry['draft']:
+                url = '/drafts/%s/' % entry['slug']
+            else:
+                url = '/%s/' % site.post_url(entry)[len(site.blog_url):]
+            routes[url] = ('posts', os.path.join(site.posts_path, post))
+        for page in site.pages:
+            routes['/%s/' % site.pages[page]['slug']] = ('pages', os.path.join(site.pages_path, page))
+        for aggregate in site.aggregates():
+            routes[self.url(site.aggregate_path(aggregate[0]))] = ('aggregate',) + aggregate
+        self.routes = dict((url, route) for (url, route) in routes.items()
+                           if route[0] == 'aggregate' or route[1] in self.sources)
+
+    def read(self, kind, name, path):
+        site = self.site
+        previous = site.state.table(kind).get(name)
+        (source, stat) = site.read_source(path, previous, kind)
+        if kind == 'posts':
+            meta = site.set_post_meta(source.meta, source.title, name, previous is None)
+            site.state.set(kind, name, site.post_entry(meta, source, stat, previous))
+            site.index.update(name, site.posts[name])
+        else:
+            meta = site.get_page_meta(source.meta, source.title)
+            site.state.set(kind, name, site.page_entry(meta, source, stat, previous))
+        self.sources[path] = (stat.st_size, stat.st_mtime_ns, meta, source)
+
+    def url(self, path):
+        url = '/' + os.path.relpath(path, self.site.webroot).replace(os.sep, '/')
+        if url.endswith('/index.html'):
+            return url[:-len('index.html')]
+        return url
+
+    def render(self, url):
+        """ The content of a URL, from memory when nothing it's built from has
+        changed. None if there's no such page.
+        """
+        site = self.site
+        route = self.routes.get(url)
+        if route is None:
+            return None
+        if route[0] == 'aggregate':
+            (_, output, inputs, _, render, template) = route
+            if template:
+                inputs = dict(inputs)
+                inputs['#template %s' % template] = [site.template_digest(template)]
+            key = json.dumps(inputs, sort_keys=True)
+        else:
+            (kind, path) = route
+            name = os.path.basename(path)
+            meta = dict(self.sources[path][2])
+            if kind == 'posts':
+                meta['neighbors'] = site.post_neighbors(name)
+            template = 'post.html' if kind == 'posts' else 'page.html'
+            key = '%s|%s|%s|%s' % (site.state.table(kind)[name]['digest'],
+                                   site.template_digest(template), site.body_cache.salt_id,
+                                   site.neighbors_digest(meta.get('neighbors')))
+        if url in self.rendered and self.rendered[url][0] == key:
+            return self.rendered[url][1]
+
+        if route[0] == 'aggregate':
+            site.capture.clear()
+            render()
+            content = site.capture.pop(site.aggregate_path(output))
+        else:
+            build = site.build_post if kind == 'posts' else site.build_page
+            (_, content) = build(meta, self.sources[path][3])
+        # Links to the blog are served from here
+        content = content.replace(site.blog_url, '/')
+        if url.endswith('/'):
+            content = content.replace('</body>', PREVIEW_SCRIPT + '</body>', 1)
+        self.rendered[url] = (key, content)
+        return content
+
+    def static_file(self, url):
+        """ Media files, and files in the webroot croissant doesn't render
+        (style sheets, scripts...)
+        """
+        if url.startswith('/media/'):
+            (directory, name) = (self.site.media_path, url[len('/media/'):])
+        elif os.path.splitext(url)[-1].lower() not in ('', '.html', '.xml', '.json'):
+            (directory, name) = (self.site.webroot, url.lstrip('/'))
+        else:
+            return None
+        directory = os.path.realpath(directory)
+        path = os.path.realpath(os.path.join(directory, name))
+        if path.startswith(directory + os.sep) and os.path.isfile(path):
+            return path
+        return None
+
+    def watched_paths(self):
+        # Media files are served straight from the source directory
+        return [self.site.posts_path, self.site.pages_path, self.site.templates_path,
+                self.site.config_path]
+
+    def watch(self, interval):
+        """ Refreshes as soon as a source, template or config file changes and
+        tells the browsers to reload
+        """
+        watcher = SourceWatcher(self.watched_paths(), interval, 0,
+                                ignore=self.site.state_files())
+        while True:
+            changed = watcher.wait()
+            started = time.perf_counter()
+            with self.lock:
+                try:
+                    if any(path.startswith(self.site.config_path) for path in changed):
+                        print('Reloading configuration')
+                        self.load()
+                        watcher.paths = self.watched_paths()
+                        watcher.last = watcher.snapshot()
+                    else:
+                        self.refresh()
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+            print('Changes detected in %d file(s), refreshed in %.1fms' % (
+                len(changed), (time.perf_counter() - started) * 1000))
+            with self.changed:
+                self.generation += 1
+                self.changed.notify_all()
+
+
+def preview(root, port=8000, interval=0.05):
+    """ Serves the site from memory on localhost, reloading the pages open in
+    a browser whenever a post, page, template or the configuration changes.
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, unquote
+    import mimetypes
+    site = Preview(root)
+
+    class PreviewHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = unquote(urlsplit(self.path).path)
+            if url == '/_preview/events':
+                return self.send_events()
+            started = time.perf_counter()
+            with site.lock:
+                try:
+                    content = site.render(url)
+                    if content is None and not url.endswith('/') and site.render(url + '/') is not None:
+                        self.send_response(301)
+                        self.send_header('Location', url + '/')
+                        self.end_headers()
+                        return
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+                    return self.send_error(500, 'Rendering failed, see the console')
+            if content is not None:
+                data = content.encode('utf-8')
+                content_type = 'text/html' if url.endswith('/') else \
+                    mimetypes.guess_type(url)[0] or 'application/octet-stream'
+                print('%s %.1fms' % (url, (time.perf_counter() - started) * 1000))
+            else:
+                path = site.static_file(url)
+                if path is None:
+                    return self.send_error(404)
+                with open(path, 'rb') as static:
+                    data = static.read()
+                content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            self.send_response(200)
+            self.send_header('Content-Type', content_type + ('; charset=utf-8' if content is not None else ''))
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_events(self):
+            """ Server-sent events: one message after every change """
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            generation = site.generation
+            try:
+                while True:
+                    with site.changed:
+                        site.changed.wait_for(lambda: site.generation != generation, timeout=15)
+                    if site.generation != generation:
+                        generation = site.generation
+                        self.wfile.write(b'data: reload\n\n')
+                    else:
+                        self.wfile.write(b': keep-alive\n\n')
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), PreviewHandler)
+    threading.Thread(target=site.watch, args=(interval,), daemon=True).start()
+    print('Previewing at http://127.0.0.1:%d/' % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
-        return text
 
 if __name__ == '__main__':
-    # credit: http://stackoverflow.com/a/789383
-    pid = str(os.getpid())
-    pidfile = '/tmp/croissant-daemon.pid'
-
-    if os.path.isfile(pidfile):
-        sys.exit('%s already exists, exiting' % pidfile)
-    with open(pidfile, 'w') as f:
-        f.write(pid)
-        try:
-            cur_path = sys.path[0]
-            croissant = Croissant(cur_path)
-            croissant.update()
-        finally:
-            os.unlink(pidfile)
+    # Nothing to do is the common case when run from cron, so it is ruled out
+    # before parsing the arguments or importing anything else
+    if len(sys.argv) == 1 and site_unchanged(sys.path[0]):
+        sys.exit(0)
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Static-file blogging engine')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and update the site whenever the source changes')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between checks for changes in watch mode')
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help='seconds without changes to wait for before updating in watch mode')
+    parser.add_argument('--stats', action='store_true',
+                        help='print time spent and counters per phase after updating')
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help='write the stats as JSON to FILE (- for stdout)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='run a single update under cProfile and save the profile to FILE')
+    parser.add_argument('--rebuild', nargs='?', const='all',
+                        choices=('posts', 'pages', 'media', 'all'),
+                        help='render everything (or only the posts, pages or media) again '
+                             'in a staging directory and swap it in when done')
+    # The fast path above only runs without arguments, so --force needs no
+    # handling of its own: it's the argument to pass to skip it
+    parser.add_argument('--force', action='store_true',
+                        help='skip the quick check for changes and check every source '
+                             '(any other option skips it too)')
+    parser.add_argument('--preview', nargs='?', const=8000, type=int, metavar='PORT',
+                        help='serve a live preview of the site from memory on localhost '
+                             '(port 8000 by default), without writing anything')
+    parser.add_argument('--sites', nargs='+', metavar='ROOT',
+                        help='update each of these croissant directories in turn, sharing one worker pool')
+    parser.add_argument('--workers', type=int,
+                        help='size of the worker pool shared by --sites (the number of CPUs by default)')
+    args = parser.parse_args()
+
+    if args.preview:
+        preview(sys.path[0], args.preview)
+        sys.exit(0)
+
+    if args.sites:
+        timings = run_sites(args.sites, args.workers, args.stats)
+        if any(status == 'failed' for (status, seconds) in timings.values()):
+            sys.exit(1)
+        sys.exit(0)
+
+    cur_path = sys.path[0]
+    try:
+        with site_lock(cur_path):
+            if args.watch:
+                watch(cur_path, args.interval, args.debounce, args.stats, args.stats_json)
+            else:
+                if args.profile:
+                    import cProfile
+                    profile = cProfile.Profile()
+                    profile.enable()
+                croissant = Croissant(cur_path)
+                try:
+                    if args.rebuild == 'all':
+                        croissant.rebuild(['posts', 'pages', 'media'])
+                    elif args.rebuild:
+                        croissant.rebuild([args.rebuild])
+                    else:
+                        croissant.update()
+                finally:
+                    croissant.close()
+                    if args.profile:
+                        profile.disable()
+                        profile.dump_stats(args.profile)
+                        print('Profile saved to', args.profile)
+                report_stats(croissant, args.stats, args.stats_json)
+    except BlockingIOError:
+        sys.exit('%s is already being updated, exiting' % cur_path)